@@ -0,0 +1,400 @@
+"""
+End-to-end benchmarks for pia-service, run against the local fake PIA API
+(see `fake_pia.py`), so that performance regressions in the server list,
+connect, port forwarding and renewal paths and in CLI startup show up
+without touching real PIA servers or needing root.
+
+Usage: python benchmarks/bench.py [-r REPEAT] [-l LATENCY_MS] [-j] [benchmark ...]
+
+Steps that need root (writing /etc/wireguard, starting systemd units) and
+waiting for a WireGuard handshake are not covered. When run without
+selecting benchmarks, it also checks that dry runs don't log in or
+register keys, that `enable` keeps the configuration it rendered, that
+`status` doesn't import requests or jinja2, and (when run as root) that
+`monitor` fails over when the tunnel is dead, and exits with an error if
+any check fails.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from fake_pia import FakePIA
+from pia_service import (auth, connect, keys, monitor, netns, port_forward, privileged,
+                         server_info, transport, tunnels)
+
+# name of the tunnel used for benchmarks, so that nothing clashes with a
+# real connection even if the state files weren't redirected
+tunnel_name = 'piabench'
+
+def measure(func, repeat, setup=None):
+    """
+    Time `repeat` calls of `func`, calling `setup` (untimed) before each.
+
+    Returns
+    -------
+    times: List of durations in seconds
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        # the package reports progress on stdout, which isn't of interest here
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'n': len(times),
+        'min_ms': round(times[0]*1000, 3),
+        'median_ms': round(statistics.median(times)*1000, 3),
+        'p90_ms': round(times[min(len(times) - 1, int(len(times)*0.9))]*1000, 3),
+        'max_ms': round(times[-1]*1000, 3),
+    }
+
+def clear_serverlist_cache():
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(server_info.cache_path)
+
+def run_benchmarks(fake, repeat, selected):
+    """
+    Run the selected benchmarks against a running fake.
+
+    Returns
+    -------
+    results: Dictionary mapping benchmark names to timing summaries
+    """
+    results = {}
+    def bench(name, func, setup=None, repeat=repeat):
+        if selected and name not in selected:
+            return
+        results[name] = summarize(measure(func, repeat, setup))
+        print(f"{name:<24} {results[name]['median_ms']:>10.3f} ms (median of {repeat})",
+              file=sys.stderr)
+
+    region_id = 'fake_0'
+    cn, ip = fake.server()
+    server = {'cn': cn, 'ip': ip}
+
+    # server list: full download and parse, revalidation, and use of the cache
+    bench('serverlist_download', lambda: server_info.fetch_serverlist(max_age=0),
+          setup=clear_serverlist_cache)
+    body = fake.serverlist.decode('utf-8')
+    bench('serverlist_parse', lambda: json.loads(body.split('\n')[0]))
+    bench('serverlist_revalidate', lambda: server_info.fetch_serverlist(max_age=0))
+    bench('serverlist_cached', lambda: server_info.get_regions())
+    bench('find_server', lambda: server_info.find_server(cn))
+
+    # connect phases
+    bench('token', lambda: auth.get_token(*fake.credentials, use_cache=False))
+    token = auth.get_token(*fake.credentials, use_cache=False)
+    bench('keypair', keys.generate_keypair)
+    keypair = keys.generate_keypair()
+    bench('add_key_cold', lambda: connect.add_key(token, keypair[1], server),
+          setup=transport.close_sessions)
+    bench('add_key_warm', lambda: connect.add_key(token, keypair[1], server))
+    bench('configure', lambda: connect.configure(token, region_id, hostname=cn,
+                                                 name=tunnel_name),
+          setup=transport.close_sessions)
+    config, status = connect.configure(token, region_id, hostname=cn, name=tunnel_name)
+    # hedged addKey with all but one server in the region answering slowly
+    slow = {other_cn: 2.0 for other_cn, other_ip in fake.live_servers[region_id][1:]}
+    def slow_servers():
+        transport.close_sessions()
+        fake.server_latency = slow
+    bench('configure_hedged', lambda: connect.configure(token, region_id, hedge=0.2,
+                                                        name=tunnel_name),
+          setup=slow_servers)
+    fake.server_latency = {}
+
+    # port forwarding: request and bind a new port (without waiting for a
+    # handshake, since there is no real tunnel). Requests for a named tunnel
+    # are sent from its own address, so give it one that exists here.
+    status['wireguard']['ip'] = '127.0.0.1'
+    bench('forward_port', lambda: port_forward.forward_port(
+              dict(status), {'token': token}, wait=0),
+          setup=transport.close_sessions)
+    with contextlib.redirect_stdout(io.StringIO()):
+        status = port_forward.forward_port(status, {'token': token}, wait=0)
+
+    # renewal: as done by the timer (new process, so no open connection) and
+    # by the daemon (connection kept open between renewals)
+    bench('renew_cold', lambda: port_forward.rebind(status), setup=transport.close_sessions)
+    bench('renew_warm', lambda: port_forward.rebind(status))
+    return results
+
+def check_enable_after_disconnect(fake):
+    """
+    Check that enabling a connection while an older, disconnected one is
+    still saved brings up the configuration that was just rendered, rather
+    than the one pia-vpn.service's `refresh` makes from the saved status.
+    Privileged operations aren't run: the files they would write are
+    recorded, and starting pia-vpn.service runs `refresh` in-process, as
+    the unit would.
+
+    Returns
+    -------
+    ok: Whether the rendered configuration was left in place
+    """
+    region_id = 'fake_0'
+    (old_cn, old_ip), (new_cn, new_ip) = fake.live_servers[region_id][:2]
+    # with a cached token, connect doesn't ask for credentials
+    token = auth.get_token(*fake.credentials)
+    with contextlib.redirect_stdout(io.StringIO()):
+        old_config, old_status = connect.configure(token, region_id, hostname=old_cn,
+                                                   name=tunnel_name, mtu=1420)
+    old_status['connection']['connected_at'] = time.time() - 2*connect.refresh_min_age
+    tunnels.save_status(old_status, tunnel_name, tunnels.saved_status_path(tunnel_name))
+
+    conf_path = f"/etc/wireguard/{tunnel_name}.conf"
+    vpn_unit = tunnels.unit_name('pia-vpn.service', tunnel_name)
+    configs = []
+    def write(transaction, path, content, mode=0o644):
+        if path == conf_path:
+            configs.append(content)
+    def apply(transaction, dry_run=False):
+        if f"systemctl start {vpn_unit}" in transaction.describe().split('\n'):
+            connect.refresh(argparse.Namespace(name=tunnel_name, budget=5,
+                                               fastest=False, dry_run=False))
+    original = privileged.Transaction.write, privileged.Transaction.apply
+    privileged.Transaction.write, privileged.Transaction.apply = write, apply
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            connect.connect(argparse.Namespace(
+                name=tunnel_name, region=region_id, hostname=new_cn,
+                forward_port=False, request_new_port=False, no_disable_ipv6=True,
+                fastest=False, renew_daemon=False, reconnect=False, dry_run=False,
+                source=[], mark=[], hedge=None, mtu=1420,
+            ), enable=True)
+    finally:
+        privileged.Transaction.write, privileged.Transaction.apply = original
+        for path in (tunnels.status_path(tunnel_name), tunnels.saved_status_path(tunnel_name)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+    return len(configs) == 1 and f"Endpoint = {new_ip}:" in configs[0]
+
+# modules that commands which don't talk to PIA or render units must not
+# import, since they make up most of the CLI's startup time
+heavy_modules = ('requests', 'urllib3', 'jinja2')
+
+def check_dry_runs(fake):
+    """
+    Check that dry runs of `connect` and `netns-up` neither log in to PIA
+    nor register keys with its servers. There is no cached token, and
+    stdin is empty, so asking for credentials fails as well.
+
+    Returns
+    -------
+    ok: Whether the fake saw no token or addKey requests
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(auth.token_path)
+    region_id = 'fake_0'
+    before = dict(fake.requests)
+    stdin = sys.stdin
+    sys.stdin = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            connect.connect(argparse.Namespace(
+                name=tunnel_name, region=region_id, hostname=None,
+                forward_port=False, request_new_port=False, no_disable_ipv6=True,
+                fastest=False, renew_daemon=False, reconnect=False, dry_run=True,
+                source=[], mark=[], hedge=None, mtu=1420,
+            ))
+            netns.netns_up(argparse.Namespace(
+                region=region_id, namespaces=[f'{tunnel_name}1', f'{tunnel_name}2'],
+                forward_port=False, no_disable_ipv6=True, fastest=False,
+                hedge=None, mtu=1420, dry_run=True,
+            ))
+    except EOFError:
+        # asked for credentials
+        return False
+    finally:
+        sys.stdin = stdin
+    return all(fake.requests[endpoint] == before.get(endpoint, 0)
+               for endpoint in ('token', 'addKey'))
+
+def check_failover_dead_tunnel():
+    """
+    Check that the monitor can fail over when the current server has
+    stopped answering: latency probes and addKey for the other servers have
+    to go around the broken tunnel, as WireGuard's own packets do. This
+    needs root, to set up routing in a network namespace of its own (see
+    `failover_in_namespace()`).
+
+    Returns
+    -------
+    ok: Whether the monitor switched servers, or `None` if the check
+        couldn't be run
+    """
+    if os.geteuid() != 0:
+        return None
+    code = "import sys, bench; sys.exit(0 if bench.failover_in_namespace() else 1)"
+    try:
+        result = subprocess.run(["unshare", "--net", sys.executable, "-c", code],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True)
+    except FileNotFoundError:
+        return None
+    return result.returncode == 0
+
+def failover_in_namespace():
+    """
+    Run in a new network namespace by `check_failover_dead_tunnel()`. After
+    connecting (on paper) to one of the fake servers, routes TCP connections
+    to the fake servers' API port into a `pia` interface that goes nowhere,
+    unless they carry the default tunnel's firewall mark, and then fails
+    over as the monitor would.
+    """
+    table = str(tunnels.default_table)
+    def ip(*args):
+        subprocess.run(["ip", *args], check=True)
+    ip("link", "set", "lo", "up")
+    ip("link", "add", "pia", "type", "veth", "peer", "name", "piapeer")
+    ip("link", "set", "pia", "up")
+    ip("link", "set", "piapeer", "up")
+
+    region_id = 'fake_0'
+    fake = FakePIA()
+    with fake, tempfile.TemporaryDirectory(prefix='pia-bench-') as state_dir:
+        with fake.patch_package(state_dir), contextlib.redirect_stdout(io.StringIO()):
+            cn, _ = fake.server()
+            token = auth.get_token(*fake.credentials)
+            config, status = connect.configure(token, region_id, hostname=cn, mtu=1420)
+            tunnels.save_status(status)
+
+            # the loopback addresses of the fake servers are in the local
+            # table, so its rule has to come after ours
+            ip("route", "add", "default", "dev", "pia", "table", table)
+            ip("rule", "add", "priority", "1", "fwmark", table, "lookup", "local")
+            ip("rule", "add", "priority", "2", "to", "127.0.0.0/8", "ipproto", "tcp",
+               "dport", "1337", "table", table)
+            ip("rule", "add", "priority", "3", "lookup", "local")
+            ip("rule", "delete", "priority", "0")
+
+            original = privileged.Transaction.apply
+            privileged.Transaction.apply = lambda transaction, dry_run=False: None
+            try:
+                new_status = monitor.failover(status, ["probe got no response"],
+                                              tunnels.default_name)
+            finally:
+                privileged.Transaction.apply = original
+    return new_status is not None and new_status['server']['cn'] != cn
+
+def check_cli_imports(command):
+    """
+    Run the CLI with the arguments `command` and check that it didn't import
+    any of `heavy_modules`.
+
+    Returns
+    -------
+    imported: List of the heavy modules that were imported
+    """
+    code = (
+        "import runpy, sys\n"
+        f"sys.argv = ['pia-service', *{command!r}]\n"
+        "try:\n"
+        "    runpy.run_module('pia_service.cli', run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print(' '.join(m for m in {heavy_modules!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=repo_dir,
+                            capture_output=True, check=True)
+    # the command's own output comes first
+    return result.stdout.decode('utf-8').split('\n')[-2].split()
+
+def bench_cli_startup(repeat, selected):
+    """
+    Time CLI startup (interpreter start, imports and argument parsing), and
+    check that `status` starts without importing `heavy_modules`.
+    """
+    results = {}
+    commands = {
+        'cli_help': ['--help'],
+        'cli_connect_help': ['connect', '--help'],
+        'cli_status': ['status'],
+    }
+    if not selected or 'cli_status' in selected:
+        imported = check_cli_imports(['status'])
+        if imported:
+            print(f"'pia-service status' imported {', '.join(imported)},"
+                  " which it doesn't need", file=sys.stderr)
+            print("Exiting.", file=sys.stderr)
+            sys.exit(1)
+    for name, command in commands.items():
+        if selected and name not in selected:
+            continue
+        argv = [sys.executable, '-m', 'pia_service.cli', *command]
+        # `status` exits with an error when there is no connection
+        run = lambda: subprocess.run(argv, cwd=repo_dir, capture_output=True)
+        results[name] = summarize(measure(run, repeat))
+        print(f"{name:<24} {results[name]['median_ms']:>10.3f} ms (median of {repeat})",
+              file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*',
+        help="Names of benchmarks to run (default: all)")
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+        help="Number of repetitions of each benchmark (default: 20)")
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+        help="Latency added by the fake API to each request, in ms (default: 0)")
+    parser.add_argument('-p', '--padding-regions', type=int, default=150,
+        help="Number of extra regions in the fake server list (default: 150)")
+    parser.add_argument('-j', '--json', action='store_true',
+        help="Print results as JSON")
+    args = parser.parse_args()
+
+    fake = FakePIA(padding_regions=args.padding_regions, latency=args.latency/1000)
+    with fake, tempfile.TemporaryDirectory(prefix='pia-bench-') as state_dir:
+        with fake.patch_package(state_dir):
+            results = run_benchmarks(fake, args.repeat, args.benchmarks)
+            if not args.benchmarks and not check_dry_runs(fake):
+                print("A dry run logged in to PIA or registered a key", file=sys.stderr)
+                print("Exiting.", file=sys.stderr)
+                sys.exit(1)
+            if not args.benchmarks and not check_enable_after_disconnect(fake):
+                print("'enable' after 'disconnect' didn't keep the configuration"
+                      " it rendered", file=sys.stderr)
+                print("Exiting.", file=sys.stderr)
+                sys.exit(1)
+    if not args.benchmarks and check_failover_dead_tunnel() is False:
+        print("'monitor' didn't fail over from a server behind a dead tunnel",
+              file=sys.stderr)
+        print("Exiting.", file=sys.stderr)
+        sys.exit(1)
+    results.update(bench_cli_startup(args.repeat, args.benchmarks))
+
+    if args.json:
+        print(json.dumps({
+            'python': sys.version.split()[0],
+            'repeat': args.repeat,
+            'latency_ms': args.latency,
+            'serverlist_bytes': len(fake.serverlist),
+            'results': results,
+        }, indent=2))
+    else:
+        print(f"{'benchmark':<24} {'n':>4} {'min':>10} {'median':>10} {'p90':>10} {'max':>10}")
+        for name, result in results.items():
+            print(f"{name:<24} {result['n']:>4}"
+                  f" {result['min_ms']:>10.3f} {result['median_ms']:>10.3f}"
+                  f" {result['p90_ms']:>10.3f} {result['max_ms']:>10.3f}")
+        print("(times in ms)")
+
+if __name__ == '__main__':
+    main()
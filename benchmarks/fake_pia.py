@@ -0,0 +1,433 @@
+"""
+A local stand-in for the PIA APIs used by pia-service: the server list,
+the token API, and the per-server addKey, getSignature and bindPort APIs.
+
+Every fake WireGuard server listens on its own loopback address
+(127.0.0.2, 127.0.0.3, ...) on the real ports (1337 and 19999), and serves
+HTTPS with a certificate for its common name, signed by a throwaway CA.
+This way requests from pia-service go through `DNSBypassAdapter`'s
+common name/IP routing exactly as they would with real PIA servers. The
+server list and token APIs are served from 127.0.0.1 on an ephemeral port.
+
+Latency and failures can be injected per endpoint, and every request is
+counted, so the fake can be used to benchmark or exercise error handling.
+Creating the certificates needs the `openssl` command line tool.
+"""
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import random
+import secrets
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+endpoints = ['serverlist', 'token', 'addKey', 'getSignature', 'bindPort']
+
+def make_certificates(directory, names):
+    """
+    Create a throwaway CA, and a server certificate signed by it that is
+    valid for `names` (common names), `localhost` and 127.0.0.1.
+
+    Returns
+    -------
+    ca_path, cert_path, key_path: Paths of the CA certificate and of the
+                                  server certificate and key
+    """
+    ca_key = os.path.join(directory, 'ca.key')
+    ca_path = os.path.join(directory, 'ca.crt')
+    key_path = os.path.join(directory, 'server.key')
+    csr_path = os.path.join(directory, 'server.csr')
+    cert_path = os.path.join(directory, 'server.crt')
+    ext_path = os.path.join(directory, 'server.ext')
+    ec = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes']
+    run = lambda *args: subprocess.run(['openssl', *args], check=True, capture_output=True)
+    run('req', '-x509', *ec, '-keyout', ca_key, '-out', ca_path, '-days', '2',
+        '-subj', '/CN=Fake PIA CA',
+        '-addext', 'basicConstraints=critical,CA:TRUE',
+        '-addext', 'keyUsage=critical,keyCertSign,cRLSign')
+    run('req', *ec, '-keyout', key_path, '-out', csr_path, '-subj', '/CN=fake-pia')
+    alt_names = ','.join([f'DNS:{name}' for name in names] + ['DNS:localhost', 'IP:127.0.0.1'])
+    with open(ext_path, 'w') as f:
+        f.write(f"subjectAltName={alt_names}\n"
+                "basicConstraints=critical,CA:FALSE\n"
+                "keyUsage=critical,digitalSignature\n"
+                "extendedKeyUsage=serverAuth\n"
+                "authorityKeyIdentifier=keyid\n"
+                "subjectKeyIdentifier=hash\n")
+    run('x509', '-req', '-in', csr_path, '-CA', ca_path, '-CAkey', ca_key,
+        '-CAcreateserial', '-out', cert_path, '-days', '2', '-extfile', ext_path)
+    return ca_path, cert_path, key_path
+
+def make_serverlist(live_servers, regions, padding_regions=0, servers_per_region=5):
+    """
+    Build a server list in the format of PIA's v6 API.
+
+    Parameters
+    ----------
+    live_servers: Dictionary mapping region ids to lists of (cn, ip) pairs
+                  for servers that are actually served by the fake
+    regions: Dictionary mapping region ids to region names
+    padding_regions: Number of additional regions to list, so that the list
+                     has a realistic size. Their servers use addresses from
+                     TEST-NET-1 (192.0.2.0/24) and are never contacted.
+    servers_per_region: Number of servers in each padding region
+    """
+    def region_entry(region_id, name, servers, port_forward):
+        entries = [{'ip': ip, 'cn': cn} for cn, ip in servers]
+        return {
+            'id': region_id,
+            'name': name,
+            'country': 'XX',
+            'auto_region': True,
+            'dns': f'{region_id}.privacy.network',
+            'port_forward': port_forward,
+            'geo': False,
+            'offline': False,
+            'servers': {
+                'meta': entries,
+                'wg': entries,
+                'ikev2': entries,
+                'ovpntcp': entries,
+                'ovpnudp': entries,
+            },
+        }
+
+    info = {
+        'groups': {
+            'wg': [{'name': 'wireguard', 'ports': [1337]}],
+            'meta': [{'name': 'meta', 'ports': [443, 8080]}],
+        },
+        'regions': [],
+    }
+    for i, (region_id, servers) in enumerate(live_servers.items()):
+        # every other live region allows port forwarding, starting with the first
+        info['regions'].append(region_entry(region_id, regions[region_id], servers, i % 2 == 0))
+    for i in range(padding_regions):
+        servers = [
+            (f'padding{i}-{j}', f'192.0.2.{(i*servers_per_region + j) % 254 + 1}')
+            for j in range(servers_per_region)
+        ]
+        info['regions'].append(region_entry(f'padding_{i}', f'Padding {i}', servers, i % 2 == 0))
+    return info
+
+class FakePIA:
+    """
+    A set of fake PIA API servers, running in background threads.
+
+    Parameters
+    ----------
+    regions: Number of regions with live servers
+    servers_per_region: Number of live WireGuard servers in each region
+    padding_regions: Number of additional (unreachable) regions to list
+    latency: Delay before answering each request, in seconds. Either a
+             number, or a dictionary mapping endpoint names (see `endpoints`)
+             to delays.
+    failure_rate: Dictionary mapping endpoint names to the probability that
+                  a request to that endpoint fails
+    server_latency: Dictionary mapping common names of live servers to an
+                    extra delay for requests to that server, in seconds
+    credentials: (username, password) pair accepted by the token API
+
+    Use as a context manager, or call `start()` and `stop()`.
+    """
+    def __init__(self, regions=2, servers_per_region=3, padding_regions=0,
+                 latency=0.0, failure_rate=None, server_latency=None,
+                 credentials=('user', 'pass')):
+        if regions * servers_per_region > 250:
+            raise ValueError("At most 250 live servers are supported")
+        self.latency = latency
+        self.failure_rate = dict(failure_rate or {})
+        self.server_latency = dict(server_latency or {})
+        self.credentials = credentials
+        self.requests = Counter()
+        self.failures = Counter()
+        self.pending_failures = Counter()
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.signatures = {}
+
+        self.live_servers = {}
+        self.region_names = {}
+        host = 2
+        for i in range(regions):
+            region_id = f'fake_{i}'
+            self.region_names[region_id] = f'Fake {i}'
+            self.live_servers[region_id] = []
+            for j in range(servers_per_region):
+                self.live_servers[region_id].append((f'fake{i}-{j}', f'127.0.0.{host}'))
+                host += 1
+        info = make_serverlist(self.live_servers, self.region_names, padding_regions)
+        # like PIA, follow the JSON document by a signature on a separate line
+        signature = base64.b64encode(secrets.token_bytes(256)).decode('ascii')
+        self.serverlist = (json.dumps(info) + '\n\n' + signature).encode('utf-8')
+        self.serverlist_etag = '"' + hashlib.sha256(self.serverlist).hexdigest()[:16] + '"'
+        self.servers = []
+        self.directory = None
+
+    @property
+    def base_url(self):
+        host, port = self.servers[0].server_address[:2]
+        return f'https://{host}:{port}'
+
+    @property
+    def serverlist_url(self):
+        return f'{self.base_url}/vpninfo/servers/v6'
+
+    @property
+    def token_url(self):
+        return f'{self.base_url}/api/client/v2/token'
+
+    def server(self, region=0, index=0):
+        """
+        Get the (cn, ip) pair of one of the live servers.
+        """
+        return self.live_servers[f'fake_{region}'][index]
+
+    def fail_next(self, endpoint, count=1):
+        """
+        Make the next `count` requests to `endpoint` fail.
+        """
+        with self.lock:
+            self.pending_failures[endpoint] += count
+
+    def delay(self, endpoint, ip):
+        if isinstance(self.latency, dict):
+            delay = self.latency.get(endpoint, 0.0)
+        else:
+            delay = self.latency
+        for servers in self.live_servers.values():
+            for cn, server_ip in servers:
+                if server_ip == ip:
+                    delay += self.server_latency.get(cn, 0.0)
+        return delay
+
+    def should_fail(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+            if self.pending_failures[endpoint] > 0:
+                self.pending_failures[endpoint] -= 1
+                fail = True
+            else:
+                fail = random.random() < self.failure_rate.get(endpoint, 0.0)
+            if fail:
+                self.failures[endpoint] += 1
+            return fail
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='fake-pia-')
+        names = [cn for servers in self.live_servers.values() for cn, ip in servers]
+        self.ca_path, cert_path, key_path = make_certificates(self.directory, names)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path, key_path)
+
+        addresses = [('127.0.0.1', 0)]
+        for servers in self.live_servers.values():
+            for cn, ip in servers:
+                addresses.extend([(ip, 1337), (ip, 19999)])
+        handler = make_handler(self)
+        for address in addresses:
+            server = ThreadingHTTPServer(address, handler)
+            server.daemon_threads = True
+            # do the TLS handshake in the request thread rather than in accept()
+            server.socket = context.wrap_socket(
+                server.socket, server_side=True, do_handshake_on_connect=False,
+            )
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @contextlib.contextmanager
+    def patch_package(self, state_dir):
+        """
+        Point pia_service at this fake, and keep all of its state files in
+        `state_dir` instead of the package directory, for the duration of
+        the context.
+        """
+        from pia_service import (auth, authority_store, keys, monitor, netns,
+                                 server_info, status, transport, tunnels)
+        patches = [
+            (server_info, 'serverlist_url', self.serverlist_url),
+            (server_info, 'cache_path', os.path.join(state_dir, 'serverlist.json')),
+            (server_info, 'cache_stats_path', os.path.join(state_dir, 'serverlist_stats.toml')),
+            (server_info, 'cache_stats_lock_path', os.path.join(state_dir, 'serverlist_stats.lock')),
+            (server_info, 'index_path', os.path.join(state_dir, 'serverlist_index.json')),
+            (auth, 'token_url', self.token_url),
+            (auth, 'token_path', os.path.join(state_dir, 'token.toml')),
+            (transport, 'ca_path', self.ca_path),
+            (authority_store, 'store_path', os.path.join(state_dir, 'port_authority.toml')),
+            (keys, 'pool_path', os.path.join(state_dir, 'keypool.toml')),
+            (tunnels, 'package_dir', state_dir),
+            (tunnels, 'registry_path', os.path.join(state_dir, 'tunnels.toml')),
+            (tunnels, 'registry_lock_path', os.path.join(state_dir, 'tunnels.lock')),
+            (status, 'package_dir', state_dir),
+            (monitor, 'failover_log_path', os.path.join(state_dir, 'failovers.jsonl')),
+            (netns, 'store_path', os.path.join(state_dir, 'netns.toml')),
+        ]
+        originals = [(module, name, getattr(module, name)) for module, name, value in patches]
+        # the server list and token APIs are requested with the default CA bundle
+        original_bundle = os.environ.get('REQUESTS_CA_BUNDLE')
+        os.environ['REQUESTS_CA_BUNDLE'] = self.ca_path
+        for module, name, value in patches:
+            setattr(module, name, value)
+        try:
+            yield
+        finally:
+            for module, name, value in originals:
+                setattr(module, name, value)
+            if original_bundle is None:
+                del os.environ['REQUESTS_CA_BUNDLE']
+            else:
+                os.environ['REQUESTS_CA_BUNDLE'] = original_bundle
+            transport.close_sessions()
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        # keep connections alive, as PIA's servers do
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, so without this, delayed
+        # ACKs would add ~40 ms to every request on a kept-alive connection
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, code, body, content_type='application/json', headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode('utf-8')
+            elif isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def dispatch(self, method):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if method == 'POST':
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode('utf-8'))
+                params.update({key: values[0] for key, values in form.items()})
+            port = self.server.server_address[1]
+            routes = {
+                ('GET', '/vpninfo/servers/v6'): 'serverlist',
+                ('POST', '/api/client/v2/token'): 'token',
+                ('GET', '/addKey'): 'addKey',
+                ('GET', '/getSignature'): 'getSignature',
+                ('GET', '/bindPort'): 'bindPort',
+            }
+            endpoint = routes.get((method, url.path))
+            # the per-server APIs are only available on their own ports
+            if (endpoint == 'addKey' and port != 1337
+                    or endpoint in ('getSignature', 'bindPort') and port != 19999):
+                endpoint = None
+            if endpoint is None:
+                self.send_body(404, 'Not found', 'text/plain')
+                return
+            delay = fake.delay(endpoint, self.server.server_address[0])
+            if delay:
+                time.sleep(delay)
+            if fake.should_fail(endpoint):
+                self.send_body(500, 'Injected failure', 'text/plain')
+                return
+            getattr(self, f'handle_{endpoint}')(params)
+
+        def do_GET(self):
+            self.dispatch('GET')
+
+        def do_POST(self):
+            self.dispatch('POST')
+
+        def handle_serverlist(self, params):
+            if self.headers.get('If-None-Match') == fake.serverlist_etag:
+                self.send_response(304)
+                self.send_header('ETag', fake.serverlist_etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_body(200, fake.serverlist, 'text/plain',
+                           headers={'ETag': fake.serverlist_etag})
+
+        def handle_token(self, params):
+            if (params.get('username'), params.get('password')) != tuple(fake.credentials):
+                self.send_body(401, 'HTTP Token: Access denied.', 'text/plain')
+                return
+            token = secrets.token_hex(64)
+            with fake.lock:
+                fake.tokens.add(token)
+            self.send_body(200, {'token': token})
+
+        def handle_addKey(self, params):
+            if params.get('pt') not in fake.tokens:
+                self.send_body(200, {'status': 'ERROR', 'message': 'Login failed!'})
+                return
+            if 'pubkey' not in params:
+                self.send_body(200, {'status': 'ERROR', 'message': 'Missing pubkey'})
+                return
+            ip = self.server.server_address[0]
+            host = int(ip.rsplit('.', 1)[1])
+            self.send_body(200, {
+                'status': 'OK',
+                'server_key': base64.b64encode(secrets.token_bytes(32)).decode('ascii'),
+                'server_port': 1337,
+                'server_ip': ip,
+                'server_vip': f'10.{host}.128.1',
+                'peer_ip': f'10.{host}.{random.randrange(129, 255)}.{random.randrange(1, 255)}',
+                'peer_pubkey': params['pubkey'],
+                'dns_servers': ['10.0.0.243', '10.0.0.242'],
+            })
+
+        def handle_getSignature(self, params):
+            if params.get('token') not in fake.tokens:
+                self.send_body(200, {'status': 'ERROR', 'message': 'Login failed!'})
+                return
+            expires_at = datetime.utcnow() + timedelta(days=60)
+            payload = base64.b64encode(json.dumps({
+                'token': params['token'],
+                'port': random.randrange(10000, 60000),
+                # PIA reports expiry dates to ns precision
+                'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.%f') + '000Z',
+            }).encode('utf-8')).decode('ascii')
+            signature = base64.b64encode(secrets.token_bytes(64)).decode('ascii')
+            with fake.lock:
+                fake.signatures[payload] = signature
+            self.send_body(200, {'status': 'OK', 'payload': payload, 'signature': signature})
+
+        def handle_bindPort(self, params):
+            with fake.lock:
+                valid = fake.signatures.get(params.get('payload')) == params.get('signature')
+            if not valid:
+                self.send_body(200, {'status': 'ERROR', 'message': 'Invalid signature'})
+                return
+            self.send_body(200, {'status': 'OK', 'message': 'port scheduled for add'})
+
+    return Handler
@@ -2,7 +2,16 @@ import requests
 import toml
 from getpass import getpass
 import os.path
+import time
 package_dir = os.path.dirname(__file__)
+token_path = os.path.join(package_dir, 'token.toml')
+
+token_url = 'https://www.privateinternetaccess.com/api/client/v2/token'
+
+# PIA tokens are valid for 24 hours. Refresh a cached token once it is
+# within `token_refresh_margin` seconds of expiring.
+token_lifetime = 24*60*60
+token_refresh_margin = 60*60
 
 class AuthFailure(Exception):
     def __init__(self, response):
@@ -24,19 +33,74 @@ def get_credentials():
         password = credentials['password']
     return username, password
 
-def get_token(username=None, password=None):
+def load_cached_token():
+    """
+    Load the cached authentication token, if there is one that isn't close
+    to expiring.
+
+    Returns
+    -------
+    token: A cached PIA authentication token, or `None`
+    """
+    try:
+        cached = toml.load(token_path)
+    except (FileNotFoundError, toml.TomlDecodeError):
+        return None
+    if time.time() >= cached['expires_at'] - token_refresh_margin:
+        return None
+    return cached['token']
+
+def save_token(token):
+    """
+    Cache an authentication token on disk, along with its issue time and
+    expiration time, taking care to deny read/write permissions to anyone
+    but the owner.
+    """
+    now = time.time()
+    cached = {'token': token, 'issued_at': now, 'expires_at': now + token_lifetime}
+    old_umask = os.umask(0o177)
+    try:
+        with open(token_path, 'w') as f:
+            toml.dump(cached, f)
+    except OSError:
+        # caching is an optimization, so don't fail if we can't write
+        pass
+    finally:
+        os.umask(old_umask)
+
+def invalidate_token():
+    """
+    Remove the cached authentication token, e.g. if it has been rejected.
+    """
+    try:
+        os.remove(token_path)
+    except FileNotFoundError:
+        pass
+
+def get_token(username=None, password=None, use_cache=True):
     """
     Get an authentication token from the PIA API.
 
+    If no username and password are given, a cached token is used if one
+    is available and not close to expiring. Otherwise, the stored (or
+    interactively entered) credentials are used to request a new token,
+    which is then cached.
+
     Parameters
     ----------
-    askpass: Whether to prompt for the username and password interactively.
-             If `False`, they will be read from the file `credentials.toml`.
+    username, password: PIA credentials. If not given, they will be read
+                        from the file `credentials.toml` or requested
+                        interactively.
+    use_cache: Whether a cached token may be used.
     """
     if username is None or password is None:
+        if use_cache:
+            token = load_cached_token()
+            if token is not None:
+                return token
         username, password = get_credentials()
     response = requests.post(
-        'https://www.privateinternetaccess.com/api/client/v2/token',
+        token_url,
         data = {'username': username, 'password': password},
     )
     try:
@@ -45,6 +109,7 @@ def get_token(username=None, password=None):
         response_content = response.content.decode('utf-8').strip()
         raise AuthFailure(response=response_content) from None
     token = response_json['token']
+    save_token(token)
     return token
 
 def login(args):
@@ -86,9 +151,11 @@ def login(args):
 
 def logout(args):
     """
-    Remove the stored username and password, if there is one.
+    Remove the stored username and password, if there is one, along with
+    any cached authentication token.
     """
     credentials_path = os.path.join(package_dir, 'credentials.toml')
+    invalidate_token()
     try:
         os.remove(credentials_path)
     except FileNotFoundError:
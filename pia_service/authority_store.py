@@ -0,0 +1,108 @@
+import os
+import toml
+from datetime import datetime
+package_dir = os.path.dirname(__file__)
+store_path = os.path.join(package_dir, "port_authority.toml")
+
+# Keep at most this many (unexpired) authorities per server
+max_per_server = 4
+
+def expiration(authority):
+    """
+    Get the expiration time of a port authority as a `datetime` (in UTC).
+    """
+    # PIA provides expiration dates to ns precision, but `datetime`
+    # doesn't know how to handle that, and the relevant clocks aren't
+    # that accurate anyway, so truncate at the us level.
+    return datetime.strptime(authority['expires_at'][:26], '%Y-%m-%dT%H:%M:%S.%f')
+
+def is_expired(authority, now=None):
+    if now is None:
+        now = datetime.utcnow()
+    return now >= expiration(authority)
+
+def load_authorities():
+    """
+    Load the stored port authorities, grouped by server.
+
+    Returns
+    -------
+    authorities: Dictionary mapping server common names to lists of port
+                 authorities, newest first. Authorities recorded before
+                 they were indexed by server are listed under 'legacy'.
+    """
+    try:
+        stored = toml.load(store_path)
+    except FileNotFoundError:
+        return {}
+    if 'server' in stored:
+        return stored['server']
+    # older, append-only format: a flat list of authorities
+    return {'legacy': sorted(
+        stored.get('authority', []),
+        key=lambda authority: authority['expires_at'],
+        reverse=True,
+    )}
+
+def compact(authorities):
+    """
+    Drop expired authorities, and all but the newest `max_per_server`
+    authorities for each server.
+    """
+    now = datetime.utcnow()
+    compacted = {}
+    for cn, server_authorities in authorities.items():
+        server_authorities = [
+            authority for authority in server_authorities
+            if not is_expired(authority, now)
+        ]
+        server_authorities.sort(key=lambda authority: authority['expires_at'], reverse=True)
+        if server_authorities:
+            compacted[cn] = server_authorities[:max_per_server]
+    return compacted
+
+def store_authority(authority, server):
+    """
+    Record a newly received port authority, compacting the store and
+    writing it atomically, readable only by the owner.
+
+    Parameters
+    ----------
+    authority: Dictionary describing the port authority
+     - key 'port': Forwarded port number
+     - key 'expires_at': Expiration date of the port
+     - key 'payload', 'signature': Payload and signature received from PIA
+    server: Dictionary representing the server that issued the authority
+     - key 'cn': Server common name
+     - key 'region': Name of the server's region
+    """
+    authorities = load_authorities()
+    authority = dict(authority, region=server['region'])
+    authorities.setdefault(server['cn'], []).insert(0, authority)
+    authorities = compact(authorities)
+
+    tmp_path = f"{store_path}.tmp"
+    old_umask = os.umask(0o177)
+    try:
+        with open(tmp_path, 'w') as f:
+            toml.dump({'server': authorities}, f)
+        os.replace(tmp_path, store_path)
+    finally:
+        os.umask(old_umask)
+
+def newest_authority(cn):
+    """
+    Get the newest unexpired port authority issued by a server.
+
+    Parameters
+    ----------
+    cn: Common name of the server
+
+    Returns
+    -------
+    authority: Dictionary describing the port authority, or `None`
+    """
+    for authority in load_authorities().get(cn, []):
+        if not is_expired(authority):
+            return authority
+    return None
@@ -1,9 +1,42 @@
-from pia_service.server_info import list_regions, region_info
-from pia_service.auth import login, logout
-from pia_service.connect import connect, disconnect
-from pia_service.status import get_status
-from pia_service.port_forward import forward_port, renew_port
-from pia_service.enable import enable, disable
+import importlib
+import os
+
+def lazy(module, name):
+    """
+    Wrap the function `name` from the submodule `module` of pia_service,
+    importing the module only when the function is called. This way each
+    command only pays the import cost of the modules it actually uses.
+    """
+    def func(args):
+        return getattr(importlib.import_module(f'pia_service.{module}'), name)(args)
+    return func
+
+def tunnel_name(value):
+    """
+    argparse type for tunnel names, so that invalid names are reported as
+    usage errors.
+    """
+    import argparse
+    from .tunnels import check_name, InvalidTunnelName
+    try:
+        return check_name(value)
+    except InvalidTunnelName as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def mtu_value(value):
+    """
+    argparse type for the `--mtu` option: 'auto', or an MTU in bytes.
+    """
+    import argparse
+    if value == 'auto':
+        return value
+    try:
+        mtu = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid MTU {value!r}")
+    if not 576 <= mtu <= 9000:
+        raise argparse.ArgumentTypeError(f"MTU {mtu} out of range (576-9000)")
+    return mtu
 
 def main():
     import argparse
@@ -12,61 +45,260 @@ def main():
     subparsers = parser.add_subparsers(metavar="command")
     parser_list_regions = subparsers.add_parser('list-regions',
         help="List available regions")
-    parser_list_regions.set_defaults(func=list_regions)
+    parser_list_regions.set_defaults(func=lazy('server_info', 'list_regions'))
     parser_list_regions.add_argument('-g', '--no-geo', action='store_true',
         help="Show only non-geolocated regions")
     parser_list_regions.add_argument('-p', '--port-forward', action='store_true',
         help="Show only regions with port forwarding enabled")
+    parser_list_regions.add_argument('-s', '--sort', choices=['name', 'latency'],
+        default='name', help="Sort regions by name or by measured latency")
+    parser_list_regions.add_argument('-n', '--top', type=int, default=None,
+        help="Show only the first N regions")
+    parser_list_regions.add_argument('-j', '--json', action='store_true',
+        help="Print the list of regions as JSON")
     parser_region = subparsers.add_parser('region',
         help="List servers in a specified region")
-    parser_region.set_defaults(func=region_info)
+    parser_region.set_defaults(func=lazy('server_info', 'region_info'))
     parser_region.add_argument('region', type=str, help="Region to use")
+    parser_cache_info = subparsers.add_parser('cache-info',
+        help="Show server list cache status and hit/miss counters")
+    parser_cache_info.set_defaults(func=lazy('server_info', 'cache_info'))
     parser_connect = subparsers.add_parser('connect',
         help="Connect to a PIA VPN server in the specified region")
-    parser_connect.set_defaults(func=connect)
+    parser_connect.set_defaults(func=lazy('connect', 'connect'))
+    parser_connect.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
+    parser_connect.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
     parser_connect.add_argument('-f', '--forward-port', action='store_true',
         help="Request a forwarded port from the server")
     parser_connect.add_argument('-F', '--request-new-port', action='store_true',
         help="Forward a port, ignoring previous ports and requesting a new one")
     parser_connect.add_argument('-6', '--no-disable-ipv6', action='store_true',
         help="Don't disable IPv6 while the PIA connection is active")
+    parser_connect.add_argument('-l', '--fastest', action='store_true',
+        help="Probe servers in the region and choose the one with the lowest latency")
+    parser_connect.add_argument('-d', '--renew-daemon', action='store_true',
+        help="Keep a forwarded port open with a resident daemon instead of a timer")
+    parser_connect.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_connect.add_argument('-s', '--source', action='append', default=[],
+        help="Route traffic from this address or CIDR range through the tunnel"
+             " (non-default tunnels only; may be repeated)")
+    parser_connect.add_argument('-m', '--mark', action='append', default=[], type=int,
+        help="Route traffic with this firewall mark through the tunnel"
+             " (non-default tunnels only; may be repeated)")
+    parser_connect.add_argument('-M', '--mtu', type=mtu_value, default='auto',
+        help="MTU of the WireGuard interface, or 'auto' to probe the path MTU to"
+             " the server and subtract WireGuard's overhead (default: auto)")
+    parser_connect.add_argument('-H', '--hedge', nargs='?', type=float, const=0.5,
+        metavar='DELAY',
+        help="If the server hasn't added our key after DELAY seconds (default: 0.5),"
+             " also try backup servers in the region, and use whichever answers first")
     parser_connect.add_argument('region', type=str, help="Specified region")
     parser_connect.add_argument('hostname', nargs='?', default=None,
         help="Hostname of specific server to connect to")
+    parser_reconnect = subparsers.add_parser('reconnect',
+        help="Restore the previous connection, reusing its configuration if possible")
+    parser_reconnect.set_defaults(func=lazy('connect', 'reconnect'))
+    parser_reconnect.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_reconnect.add_argument('-D', '--deadline', type=float, default=5.0,
+        help="Connect from scratch if there is no handshake with the saved server"
+             " within DEADLINE seconds (default: 5)")
+    parser_reconnect.add_argument('-l', '--fastest', action='store_true',
+        help="When connecting from scratch, choose the server with the lowest latency")
+    parser_reconnect.add_argument('-H', '--hedge', nargs='?', type=float, const=0.5,
+        metavar='DELAY',
+        help="When connecting from scratch, hedge addKey requests (see connect --hedge)")
+    parser_reconnect.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_reconnect.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
+    parser_refresh = subparsers.add_parser('refresh',
+        help="Re-register the saved configuration's key before bringing it up"
+             " (run by pia-vpn.service at boot)")
+    parser_refresh.set_defaults(func=lazy('connect', 'refresh'))
+    parser_refresh.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_refresh.add_argument('-b', '--budget', type=float, default=20.0,
+        help="Use the saved configuration as it is if refreshing takes longer"
+             " than BUDGET seconds (default: 20)")
+    parser_refresh.add_argument('-l', '--fastest', action='store_true',
+        help="If the saved server can't be used, choose the one with the lowest latency")
+    parser_refresh.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_refresh.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
+    parser_switch = subparsers.add_parser('switch',
+        help="Move the active connection to another server without disconnecting")
+    parser_switch.set_defaults(func=lazy('connect', 'switch'))
+    parser_switch.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_switch.add_argument('-l', '--fastest', action='store_true',
+        help="Probe servers in the region and choose the one with the lowest latency")
+    parser_switch.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_switch.add_argument('region', nargs='?', default=None,
+        help="Region to switch to (default: current region)")
+    parser_switch.add_argument('hostname', nargs='?', default=None,
+        help="Hostname of specific server to switch to")
+    parser_monitor = subparsers.add_parser('monitor',
+        help="Monitor the connection and fail over to another server if it degrades")
+    parser_monitor.set_defaults(func=lazy('monitor', 'monitor'))
+    parser_monitor.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_monitor.add_argument('-i', '--interval', type=float, default=30,
+        help="Seconds between health checks (default 30)")
+    parser_monitor.add_argument('--max-handshake-age', type=float, default=180,
+        help="Maximum age of the latest WireGuard handshake in seconds (default 180)")
+    parser_monitor.add_argument('--max-rtt', type=float, default=1000,
+        help="Maximum round-trip time of the server probe in ms (default 1000)")
+    parser_monitor.add_argument('--failures', type=int, default=3,
+        help="Consecutive failed checks before failing over (default 3)")
+    parser_export = subparsers.add_parser('export',
+        help="Export tunnel and port forwarding metrics for Prometheus")
+    parser_export.set_defaults(func=lazy('exporter', 'export'))
+    parser_export.add_argument('-o', '--textfile', metavar='PATH',
+        help="Write metrics to this file (for node-exporter's textfile collector)"
+             " instead of stdout")
+    parser_export.add_argument('-i', '--interval', type=float,
+        help="With --textfile, rewrite the file every INTERVAL seconds")
+    parser_export.add_argument('-l', '--listen', metavar='[HOST:]PORT',
+        help="Serve metrics over HTTP at /metrics (HOST defaults to 127.0.0.1)")
     parser_status = subparsers.add_parser('status',
         help="Check status of PIA connection")
-    parser_status.set_defaults(func=get_status)
+    parser_status.set_defaults(func=lazy('status', 'get_status'))
+    parser_status.add_argument('-N', '--name', default=None, type=tunnel_name,
+        help="Name of the tunnel to show (default: all connected tunnels)")
     parser_status.add_argument('-v', '--verbose', action='store_true',
         help="Print additional status information")
+    parser_status.add_argument('-j', '--json', action='store_true',
+        help="Print a snapshot of the live tunnel state as JSON (one line per tunnel)")
+    parser_status.add_argument('-w', '--watch', type=float, nargs='?', const=1.0,
+        default=None, metavar='INTERVAL',
+        help="Print live tunnel state every INTERVAL seconds (default 1)")
     parser_disconnect = subparsers.add_parser('disconnect',
         help="Disconnect from PIA")
-    parser_disconnect.set_defaults(func=disconnect)
+    parser_disconnect.set_defaults(func=lazy('connect', 'disconnect'))
+    parser_disconnect.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_disconnect.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
     parser_enable = subparsers.add_parser('enable',
         help="Create a persistent connection to a PIA VPN server")
-    parser_enable.set_defaults(func=enable)
+    parser_enable.set_defaults(func=lazy('enable', 'enable'))
+    parser_enable.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
+    parser_enable.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
     parser_enable.add_argument('-f', '--forward-port', action='store_true',
         help="Forward a port, using previously forwarded port if possible")
     parser_enable.add_argument('-F', '--request-new-port', action='store_true',
         help="Forward a port, ignoring previous ports and requesting a new one")
     parser_enable.add_argument('-6', '--no-disable-ipv6', action='store_true',
         help="Don't disable IPv6 while the PIA connection is active")
+    parser_enable.add_argument('-l', '--fastest', action='store_true',
+        help="Probe servers in the region and choose the one with the lowest latency")
+    parser_enable.add_argument('-d', '--renew-daemon', action='store_true',
+        help="Keep a forwarded port open with a resident daemon instead of a timer")
+    parser_enable.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_enable.add_argument('-s', '--source', action='append', default=[],
+        help="Route traffic from this address or CIDR range through the tunnel"
+             " (non-default tunnels only; may be repeated)")
+    parser_enable.add_argument('-m', '--mark', action='append', default=[], type=int,
+        help="Route traffic with this firewall mark through the tunnel"
+             " (non-default tunnels only; may be repeated)")
+    parser_enable.add_argument('-M', '--mtu', type=mtu_value, default='auto',
+        help="MTU of the WireGuard interface, or 'auto' to probe the path MTU to"
+             " the server and subtract WireGuard's overhead (default: auto)")
+    parser_enable.add_argument('-H', '--hedge', nargs='?', type=float, const=0.5,
+        metavar='DELAY',
+        help="If the server hasn't added our key after DELAY seconds (default: 0.5),"
+             " also try backup servers in the region, and use whichever answers first")
+    parser_enable.add_argument('-r', '--reconnect', action='store_true',
+        help="At boot, restore the connection with `reconnect` (reusing the saved"
+             " configuration if the server still accepts it) instead of always"
+             " bringing up the saved configuration")
     parser_enable.add_argument('region', type=str, help="Specified region")
     parser_enable.add_argument('hostname', nargs='?', default=None,
         help="Hostname of specific server to connect to")
     parser_disable = subparsers.add_parser('disable',
         help="Disable a connection and remove associated files")
-    parser_disable.set_defaults(func=disable)
+    parser_disable.set_defaults(func=lazy('enable', 'disable'))
+    parser_disable.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_disable.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
     parser_login = subparsers.add_parser('login',
         help="Store PIA username and password for future use")
-    parser_login.set_defaults(func=login)
+    parser_login.set_defaults(func=lazy('auth', 'login'))
     parser_login = subparsers.add_parser('logout',
         help="Remove stored PIA username and password")
-    parser_login.set_defaults(func=logout)
+    parser_login.set_defaults(func=lazy('auth', 'logout'))
     parser_renew_port = subparsers.add_parser('renew-port',
         help="Renew the current port forward binding"
     )
-    parser_renew_port.set_defaults(func=renew_port)
+    parser_renew_port.set_defaults(func=lazy('port_forward', 'renew_port'))
+    parser_renew_port.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
+    parser_renew_port.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_daemon = subparsers.add_parser('daemon',
+        help="Run the port forward renewal daemon"
+    )
+    parser_daemon.set_defaults(func=lazy('daemon', 'daemon'))
+    parser_daemon.add_argument('-N', '--name', default='pia', type=tunnel_name,
+        help="Name of the tunnel (and WireGuard interface) to use (default: pia)")
+    parser_netns_up = subparsers.add_parser('netns-up',
+        help="Give each of several network namespaces its own PIA tunnel")
+    parser_netns_up.set_defaults(func=lazy('netns', 'netns_up'))
+    parser_netns_up.add_argument('-f', '--forward-port', action='store_true',
+        help="Request a forwarded port for each namespace (requires root)")
+    parser_netns_up.add_argument('-6', '--no-disable-ipv6', action='store_true',
+        help="Don't disable IPv6 inside the namespaces")
+    parser_netns_up.add_argument('-l', '--fastest', action='store_true',
+        help="Choose the server with the lowest latency (instead of a random one)"
+             " for each namespace")
+    parser_netns_up.add_argument('-M', '--mtu', type=mtu_value, default='auto',
+        help="MTU of the WireGuard interface, or 'auto' to probe the path MTU to"
+             " the server and subtract WireGuard's overhead (default: auto)")
+    parser_netns_up.add_argument('-H', '--hedge', nargs='?', type=float, const=0.5,
+        metavar='DELAY',
+        help="If a server hasn't added a key after DELAY seconds (default: 0.5),"
+             " also try backup servers in the region, and use whichever answers first")
+    parser_netns_up.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_netns_up.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
+    parser_netns_up.add_argument('region', type=str, help="Specified region")
+    parser_netns_up.add_argument('namespaces', nargs='+', type=tunnel_name,
+        metavar='namespace', help="Network namespace (created if it doesn't exist)")
+    parser_netns_down = subparsers.add_parser('netns-down',
+        help="Remove the PIA tunnels from network namespaces")
+    parser_netns_down.set_defaults(func=lazy('netns', 'netns_down'))
+    parser_netns_down.add_argument('-a', '--all', action='store_true',
+        help="Remove the tunnels from all provisioned namespaces")
+    parser_netns_down.add_argument('-n', '--dry-run', action='store_true',
+        help="Print the privileged operations that would be run instead of running them")
+    parser_netns_down.add_argument('namespaces', nargs='*', type=tunnel_name,
+        metavar='namespace', help="Network namespace")
+    parser_netns_status = subparsers.add_parser('netns-status',
+        help="Show the PIA tunnels of all provisioned network namespaces")
+    parser_netns_status.set_defaults(func=lazy('netns', 'netns_status'))
+    parser_netns_status.add_argument('-j', '--json', action='store_true',
+        help="Print the status as JSON")
+    parser_netns_renew = subparsers.add_parser('netns-renew',
+        help="Renew the forwarded ports of all provisioned network namespaces")
+    parser_netns_renew.set_defaults(func=lazy('netns', 'netns_renew'))
+    parser_netns_renew.add_argument('-t', '--trace', action='store_true',
+        help="Record timing spans for each phase in trace.jsonl (also enabled by PIA_TRACE=1)")
     args = parser.parse_args()
+    if getattr(args, 'trace', False):
+        # the trace module checks the environment, and isn't imported here
+        # to keep startup fast
+        os.environ['PIA_TRACE'] = '1'
     args.func(args)
 
 if __name__ == '__main__':
@@ -1,37 +1,58 @@
-import requests
+import argparse
 import subprocess
-import toml
 import random
 import os
 import sys
+import time
 import getpass
 import sysconfig
-from datetime import datetime
-from jinja2 import Environment, PackageLoader
-jinja_env = Environment(loader=PackageLoader("pia_service"), trim_blocks=True)
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future
 package_dir = os.path.dirname(__file__)
 
-from .server_info import get_regions
-from .transport import DNSBypassAdapter
-from .auth import get_token, AuthFailure
+from .server_info import get_index, find_server
+from .transport import get_session
+from .auth import get_token, get_credentials, load_cached_token, invalidate_token, AuthFailure
 from .port_forward import forward_port
+from .probe import fastest_server, tcp_rtt, bypass_socket_options
+from .keys import create_keypair
+from .privileged import Transaction, ApplyFailure
+from .authority_store import newest_authority, is_expired
+from .telemetry import wait_for_handshake
+from . import mtu as path_mtu
+from . import trace
+from .tunnels import (default_name, default_table, check_name, status_path, load_status,
+                      save_status, unit_name, routing_table, saved_status_path,
+                      load_saved_status, restore_ownership, reconnect_marker_path)
+
+jinja_env = None
+
+def get_template(name):
+    """
+    Load one of the package's templates. The Jinja environment is only
+    created when it is first needed, since importing jinja2 is relatively
+    slow and commands like `disconnect` never render anything.
+    """
+    global jinja_env
+    if jinja_env is None:
+        from jinja2 import Environment, PackageLoader
+        jinja_env = Environment(loader=PackageLoader("pia_service"), trim_blocks=True)
+    return jinja_env.get_template(name)
+
+# Give up on an addKey request after this many seconds
+add_key_timeout = 10
+# Number of backup servers tried by a hedged addKey
+hedge_backups = 2
+# Connections set up less than this many seconds ago aren't refreshed
+refresh_min_age = 600
 
 class KeyAddFailure(Exception):
     def __init__(self, response):
         super().__init__(response)
         self.response = response
 
-def create_keypair():
-    """
-    Create a WireGuard private key and the corresponding public key.
-    """
-    result = subprocess.run(["wg", "genkey"], capture_output=True)
-    key = result.stdout.strip()
-    result = subprocess.run(["wg", "pubkey"], input=key, capture_output=True)
-    pubkey = result.stdout.strip()
-    return key.decode('ascii'), pubkey.decode('ascii')
-
-def add_key(token, pubkey, server):
+def add_key(token, pubkey, server, timeout=add_key_timeout, socket_options=()):
     """
     Request that a PIA WireGuard server add a public key.
 
@@ -42,31 +63,115 @@ def add_key(token, pubkey, server):
     server: Dictionary representing WireGuard server
      - key 'cn': Server common name
      - key 'ip': Server IP address
+    timeout: Give up (raising `KeyAddFailure`) after this many seconds
+    socket_options: Extra options for the connection's socket (see
+                    `probe.bypass_socket_options()`)
     """
+    import requests
     cn = server['cn']
     ip = server['ip']
-    session = requests.Session()
-    session.mount(f'https://{cn}', DNSBypassAdapter(cn, ip))
-    response = session.get(
-        f'https://{cn}:1337/addKey',
-        params={'pt': token, 'pubkey': pubkey},
-        verify=os.path.join(package_dir, "ca.rsa.4096.crt"),
-    )
-    response_json = response.json()
+    session = get_session(cn, ip, socket_options)
+    try:
+        response = session.get(
+            f'https://{cn}:1337/addKey',
+            params={'pt': token, 'pubkey': pubkey},
+            timeout=timeout,
+        )
+    except requests.exceptions.RequestException as exc:
+        raise KeyAddFailure(response=f"{cn}: {exc}") from None
+    try:
+        response_json = response.json()
+    except ValueError:
+        raise KeyAddFailure(
+            response=f"{cn}: HTTP {response.status_code}: {response.text.strip()}"
+        ) from None
     if not 'status' in response_json or not response_json['status'] == 'OK':
         raise KeyAddFailure(response=response_json)
     return response_json
 
-def get_server(region, hostname=None):
+def hedged_add_key(token, pubkey, servers, delay, socket_options=()):
+    """
+    Add a public key to the first of several servers that accepts it.
+
+    The request goes to the first server. If it hasn't succeeded within
+    `delay` seconds, or fails, the next server is tried as well, without
+    abandoning the requests already made, and so on. The first successful
+    response wins. Any other registrations are simply left to expire,
+    since a key that never completes a handshake is dropped by the server.
+
+    Parameters
+    ----------
+    token: PIA authentication token
+    pubkey: WireGuard public key
+    servers: List of candidate servers, in order of preference
+    delay: Seconds to wait for a response before trying the next server
+    socket_options: Extra options for the connections' sockets (see `add_key()`)
+
+    Returns
+    -------
+    server: The server that added the key
+    result: Its response (see `add_key()`)
+    """
+    # the requests run in daemon threads, so that the ones that lost don't
+    # keep the process from exiting until they time out
+    results = queue.Queue()
+    remaining = list(servers)
+    pending = 0
+    failure = None
+
+    def launch():
+        nonlocal pending
+        server = remaining.pop(0)
+        attempt = trace.traced('add_key', add_key, server=server['cn'],
+                               hedge=len(servers) - len(remaining) - 1)
+        def run():
+            try:
+                results.put((server, attempt(token, pubkey, server,
+                                             socket_options=socket_options), None))
+            except Exception as exc:
+                results.put((server, None, exc))
+        threading.Thread(target=run, daemon=True).start()
+        pending += 1
+
+    launch()
+    while True:
+        try:
+            server, result, exc = results.get(timeout=delay if remaining else None)
+        except queue.Empty:
+            # the delay has passed
+            print(f"Slow response from server, also trying {remaining[0]['cn']}")
+            launch()
+            continue
+        pending -= 1
+        if exc is None:
+            return server, result
+        if not isinstance(exc, KeyAddFailure):
+            raise exc
+        failure = exc
+        if remaining:
+            if pending:
+                print(f"Slow response from server, also trying {remaining[0]['cn']}")
+            else:
+                print(f"Trying {remaining[0]['cn']} instead")
+            launch()
+        elif not pending:
+            raise failure
+
+def get_server(region, hostname=None, fastest=False, socket_options=()):
     """
     Select and retrieve information about a WireGuard server from a specified
     PIA region. If `hostname` is specified, choose the server with that name.
-    Otherwise, choose randomly from the available servers in the region.
+    Otherwise, if `fastest` is set, probe all servers in the region and choose
+    the one with the lowest round-trip time, or else choose randomly from the
+    available servers in the region.
 
     Parameters
     ----------
     region: Name of a PIA region
     hostname: (Optional) Hostname of preferred server
+    fastest: Whether to choose the server with the lowest latency
+    socket_options: Extra options for the latency probes' sockets (see
+                    `probe.bypass_socket_options()`)
 
     Returns
     -------
@@ -74,17 +179,61 @@ def get_server(region, hostname=None):
     server: Dictionary representing WireGuard server
      - key 'cn': Server common name
      - key 'ip': Server IP address
+    rtts: Dictionary mapping server common names to measured round-trip
+          times in seconds, or `None` if the servers weren't probed
     """
-    regions = get_regions()
-    region = regions[region]
-    if hostname is None:
-        server = random.choice(region['servers']['wg'])
+    index = get_index()
+    region = index['regions'][region]
+    rtts = None
+    if hostname is not None:
+        server_region, server = find_server(hostname, index)
+        if server_region['id'] != region['id']:
+            raise KeyError(hostname)
+    elif fastest:
+        server, rtts = fastest_server(region['servers']['wg'],
+                                      socket_options=socket_options)
+        if server is None:
+            print("No servers responded to latency probe,"
+                  " choosing one at random.", file=sys.stderr)
+            server = random.choice(region['servers']['wg'])
+        else:
+            print(f"Fastest server is {server['cn']}"
+                  f" ({rtts[server['cn']]*1000:.1f} ms)")
     else:
-        wg_servers = {server['cn']: server for server in region['servers']['wg']}
-        server = wg_servers[hostname]
-    return region, server
+        server = random.choice(region['servers']['wg'])
+    return region, server, rtts
 
-def configure(token, region, hostname=None, disable_ipv6=True):
+def dry_run_peer(server):
+    """
+    Stand-in for an addKey response, used to render a configuration for a
+    dry run without registering a key with PIA.
+    """
+    return {
+        'peer_ip': '10.0.0.2',
+        'server_key': 'SERVER_PUBLIC_KEY',
+        'server_port': 1337,
+        'server_ip': server['ip'],
+        'server_vip': '10.0.0.1',
+        'dns_servers': ['10.0.0.242', '10.0.0.243'],
+    }
+
+def backup_servers(region, server, rtts=None, count=hedge_backups):
+    """
+    Choose servers in a region to fall back on if `server` is slow to
+    respond: the fastest other servers if latencies were measured, or else
+    a random selection.
+    """
+    others = [other for other in region['servers']['wg'] if other['cn'] != server['cn']]
+    if rtts is None:
+        return random.sample(others, min(count, len(others)))
+    reachable = [other for other in others if rtts.get(other['cn']) is not None]
+    reachable.sort(key=lambda other: rtts[other['cn']])
+    return reachable[:count]
+
+@trace.timed('configure')
+def configure(token, region, hostname=None, disable_ipv6=True, fastest=False,
+              keypair=None, name=default_name, sources=(), marks=(), hedge=None,
+              mtu='auto', dry_run=False, socket_options=()):
     """
     Set up a PIA WireGuard connection by creating a WireGuard keypair,
     adding the public key to a specified PIA server, and filling in the
@@ -92,31 +241,116 @@ def configure(token, region, hostname=None, disable_ipv6=True):
 
     Parameters
     ----------
-    token: Valid PIA authentication token
+    token: Valid PIA authentication token, or a `Future` that will produce
+           one (so that getting the token can overlap with the other stages)
     region: Name of a PIA region
     hostname: (Optional) Hostname of preferred server
     disable_ipv6: Whether IPv6 is to be disabled (used only for status)
+    fastest: Whether to choose the server in the region with the lowest latency
+    keypair: (Optional) Existing WireGuard (key, pubkey) pair to register,
+             instead of creating a new one
+    name: Name of the tunnel (and its WireGuard interface). Only the default
+          tunnel routes all traffic and sets the system's DNS servers.
+    sources: Source addresses (or CIDR ranges) to route through the tunnel,
+             if it isn't the default tunnel
+    marks: Firewall marks of traffic to route through the tunnel, if it
+           isn't the default tunnel
+    hedge: If given (and `hostname` isn't), also try up to `hedge_backups`
+           other servers in the region if the chosen server hasn't added
+           the key after this many seconds (see `hedged_add_key()`)
+    mtu: MTU of the tunnel interface, 'auto' to base it on the path MTU to
+         the server (see `mtu.discover()`), or `None` to leave it to wg-quick
+    dry_run: Don't register the key with PIA (so `token` isn't needed), and
+             fill in placeholders for the values the server would provide
+    socket_options: Extra options for the sockets of latency probes and
+                    addKey requests (see `probe.bypass_socket_options()`)
 
     Returns
     -------
     config: WireGuard configuration file with server details filled in
     status: Dictionary representing connection status
     """
-    region, server = get_server(region, hostname)
-    key, pubkey = create_keypair()
-
-    result = add_key(token, pubkey, server)
-    config_template = jinja_env.get_template('pia.conf.jinja')
-    config = config_template.render(
-        peer_ip=result['peer_ip'],
-        key=key,
-        dns_servers=' '.join(ip for ip in result['dns_servers']),
-        server_pubkey=result['server_key'],
-        endpoint=f"{server['ip']}:{result['server_port']}",
-        disable_ipv6=disable_ipv6,
-    )
+    # selecting a server (which may mean downloading the server list and
+    # probing servers), creating a keypair and loading the template don't
+    # depend on each other, so do them concurrently, and only wait for all
+    # of them (and the token) when we are ready to add the key
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        server_future = executor.submit(
+            trace.traced('get_server', get_server, fastest=fastest),
+            region, hostname, fastest, socket_options,
+        )
+        if keypair is None:
+            keypair_future = executor.submit(trace.traced('keypair', create_keypair))
+        template_future = executor.submit(
+            trace.traced('load_template', get_template), 'pia.conf.jinja'
+        )
+        if isinstance(token, Future) and not dry_run:
+            with trace.span('wait_token'):
+                token = token.result()
+        region, server, rtts = server_future.result()
+        if keypair is None:
+            key, pubkey = keypair_future.result()
+        else:
+            key, pubkey = keypair
+        config_template = template_future.result()
+
+    # probing the path MTU takes about a round trip, so overlap it with addKey.
+    # WireGuard's packets leave by the main table whichever tunnel they are
+    # for, and the default tunnel's mark takes that path even while the
+    # rules of this tunnel aren't in place yet
+    table = routing_table(name)
+    probed_ip = server['ip']
+    if mtu == 'auto':
+        discovery = ThreadPoolExecutor(max_workers=1)
+        mtu_future = discovery.submit(
+            trace.traced('discover_mtu', path_mtu.discover), probed_ip, default_table,
+        )
+        discovery.shutdown(wait=False)
+    if dry_run:
+        result = dry_run_peer(server)
+    elif hedge is None or hostname is not None:
+        with trace.span('add_key', server=server['cn']):
+            result = add_key(token, pubkey, server, socket_options=socket_options)
+    else:
+        candidates = [server] + backup_servers(region, server, rtts)
+        with trace.span('hedged_add_key', candidates=len(candidates)) as fields:
+            server, result = hedged_add_key(token, pubkey, candidates, hedge,
+                                            socket_options)
+            fields['server'] = server['cn']
+    if mtu == 'auto':
+        with trace.span('wait_mtu'):
+            mtu_status = mtu_future.result()
+        if server['ip'] != probed_ip:
+            # a backup server added the key first, and the path to it may
+            # well differ from the one that was probed
+            with trace.span('discover_mtu', server=server['cn']):
+                mtu_status = path_mtu.discover(server['ip'], default_table)
+    elif mtu is None:
+        mtu_status = None
+    else:
+        mtu_status = {'value': mtu, 'method': 'manual'}
+    with trace.span('render_config'):
+        config = config_template.render(
+            peer_ip=result['peer_ip'],
+            key=key,
+            dns_servers=' '.join(ip for ip in result['dns_servers']),
+            server_pubkey=result['server_key'],
+            endpoint=f"{server['ip']}:{result['server_port']}",
+            disable_ipv6=disable_ipv6,
+            table=table,
+            default_route=(name == default_name),
+            sources=sources,
+            marks=marks,
+            mtu=mtu_status and mtu_status['value'],
+        )
 
     status = {
+        'interface': name,
+        'routing': {
+            'table': table,
+            'sources': list(sources),
+            'marks': list(marks),
+        },
         'connection': {
             'pub_ip': result['server_ip'],
             'dns_servers': result['dns_servers'],
@@ -131,130 +365,701 @@ def configure(token, region, hostname=None, disable_ipv6=True):
         },
         'server': {
             'region': region['name'],
+            'region_id': region['id'],
             'cn': server['cn'],
             'ip': server['ip'],
             'port': result['server_port'],
             'allows_port_forwarding': region['port_forward'],
         },
     }
+    if mtu_status is not None:
+        status['mtu'] = mtu_status
+    if rtts is not None:
+        # record latencies in ms, leaving out servers that didn't respond
+        status['latency'] = {
+            cn: round(rtt*1000, 1) for cn, rtt in rtts.items() if rtt is not None
+        }
 
     return config, status
 
-def connect(args):
+def choose_authority(status, token, reuse=True):
+    """
+    Decide how to get a forwarded port on the server described by `status`:
+    reuse the newest unexpired port that server issued to us if there is
+    one (and `reuse` is set), and otherwise request a new one.
+
+    Returns
+    -------
+    authority: Port forwarding authority, as expected by `forward_port()`
+    """
+    authority = None
+    if reuse:
+        authority = newest_authority(status['server']['cn'])
+    if authority is not None:
+        print(f"Attempting to bind existing port {authority['port']}")
+        return authority
+    print("Requesting new forwarded port")
+    return {'token': token}
+
+def render_units(forward, renew_daemon, name=default_name, reconnect=False,
+                 refresh=False):
+    """
+    Render the systemd unit files for a connection.
+
+    Parameters
+    ----------
+    forward: Whether a port is being forwarded
+    renew_daemon: Whether to keep the port open with the renewal daemon
+                  (rather than the timer)
+    name: Name of the tunnel
+    reconnect: Whether to include the unit restoring the connection at boot
+               with `reconnect`
+    refresh: Whether pia-vpn.service should bring the saved configuration up
+             to date with `refresh` before starting the tunnel
+
+    Returns
+    -------
+    units: Dictionary mapping paths to unit file contents
+    """
+    vpn_unit = unit_name("pia-vpn.service", name)
+    if not forward:
+        renew_unit = None
+    elif renew_daemon:
+        renew_unit = unit_name("pia-pf-daemon.service", name)
+    else:
+        renew_unit = unit_name("pia-pf-renew.service", name)
+    pia_service = os.path.join(sysconfig.get_path("scripts"), "pia-service")
+    units = {
+        f"/etc/systemd/system/{vpn_unit}": get_template("pia-vpn.service.jinja").render(
+            name=name,
+            renew_unit=renew_unit,
+            pia_service=pia_service if refresh else None,
+        ),
+    }
+    if renew_daemon:
+        units[f"/etc/systemd/system/{renew_unit}"] = get_template(
+            "pia-pf-daemon.service.jinja"
+        ).render(
+            user=getpass.getuser(),
+            pia_service=pia_service,
+            name=name,
+            vpn_unit=vpn_unit,
+        )
+    elif forward:
+        timer_unit = unit_name("pia-pf-renew.timer", name)
+        units[f"/etc/systemd/system/{timer_unit}"] = get_template(
+            "pia-pf-renew.timer.jinja"
+        ).render(vpn_unit=vpn_unit)
+        units[f"/etc/systemd/system/{renew_unit}"] = get_template(
+            "pia-pf-renew.service.jinja"
+        ).render(user=getpass.getuser(), pia_service=pia_service, name=name)
+    if reconnect:
+        units[f"/etc/systemd/system/{unit_name('pia-reconnect.service', name)}"] = get_template(
+            "pia-reconnect.service.jinja"
+        ).render(user=getpass.getuser(), pia_service=pia_service, name=name)
+    return units
+
+@trace.timed('connect')
+def connect(args, enable=False):
     """
     Connect to a PIA WireGuard server in the specified region.
+    If `enable` is set, also enable the systemd service, so that the
+    connection is restored at boot.
     """
+    started = time.monotonic()
+    name = check_name(args.name)
+    if name == default_name and (args.source or args.mark):
+        # the default tunnel takes the default route, so carries everything
+        print("--source and --mark only apply to tunnels other than the"
+              f" default one ({default_name!r}); choose one with --name.",
+              file=sys.stderr)
+        print("Exiting.", file=sys.stderr)
+        return
     # abort if already connected
-    if subprocess.run(["ip", "link", "show", "pia"], capture_output=True).returncode == 0:
-        print('Device "pia" already exists, aborting.', file=sys.stderr)
+    if subprocess.run(["ip", "link", "show", name], capture_output=True).returncode == 0:
+        print(f'Device "{name}" already exists, aborting.', file=sys.stderr)
         return
+    if name != default_name and not args.no_disable_ipv6:
+        # IPv6 is disabled system-wide, so leave it to the default tunnel
+        args.no_disable_ipv6 = True
+
+    forward = args.forward_port or args.request_new_port
+    renew_daemon = forward and args.renew_daemon
+    reconnect_at_boot = enable and args.reconnect
+
+    # if we will have to ask for credentials, do it now, before anything
+    # else starts printing (a dry run doesn't talk to PIA, so needs none)
+    username = password = None
+    if not args.dry_run and load_cached_token() is None:
+        with trace.span('get_credentials'):
+            username, password = get_credentials()
 
+    # getting a token and rendering the unit files are independent of
+    # each other and of the stages in configure(), so run them concurrently
+    executor = ThreadPoolExecutor(max_workers=2)
+    if args.dry_run:
+        token_future = None
+    else:
+        token_future = executor.submit(
+            trace.traced('get_token', get_token), username, password,
+        )
+    units_future = executor.submit(
+        trace.traced('render_units', render_units),
+        forward, renew_daemon, name, reconnect_at_boot, enable,
+    )
+    executor.shutdown(wait=False)
     try:
-        token = get_token()
+        config, status = configure(
+            token_future,
+            args.region,
+            args.hostname,
+            not args.no_disable_ipv6,
+            args.fastest,
+            name=name,
+            sources=args.source,
+            marks=args.mark,
+            hedge=args.hedge,
+            mtu=args.mtu,
+            dry_run=args.dry_run,
+        )
+        token = token_future and token_future.result()
     except AuthFailure as exc:
         print("PIA authentication failed. Received response:")
         print(exc.response)
         print("Exiting.")
         return
-    else:
+    except KeyAddFailure as exc:
         print("PIA authentication OK")
+        # the token may have been cached and since revoked, so get a fresh
+        # one and try again before giving up
+        invalidate_token()
+        try:
+            with trace.span('get_token', retry=True):
+                token = get_token(use_cache=False)
+            config, status = configure(
+                token,
+                args.region,
+                args.hostname,
+                not args.no_disable_ipv6,
+                args.fastest,
+                name=name,
+                sources=args.source,
+                marks=args.mark,
+                hedge=args.hedge,
+                mtu=args.mtu,
+            )
+        except AuthFailure as exc:
+            print("PIA authentication failed. Received response:")
+            print(exc.response)
+            print("Exiting.")
+            return
+        except KeyAddFailure as exc:
+            print("Failed to add key to server. Response was:", file=sys.stderr)
+            print(f"{exc.response}", file=sys.stderr)
+            print("Exiting.", file=sys.stderr)
+            return
+    else:
+        if args.dry_run:
+            print(f"Dry run: would register a new key with {status['server']['cn']}")
+        else:
+            print("PIA authentication OK")
+    if not args.dry_run:
+        print("Successfully added WireGuard key to server")
 
+    transaction = Transaction()
+    transaction.mkdir("/etc/wireguard")
+    transaction.write(f"/etc/wireguard/{name}.conf", config, mode=0o600)
+    for path, content in units_future.result().items():
+        transaction.write(path, content)
+    transaction.systemctl("daemon-reload")
+    transaction.systemctl("start", unit_name("pia-vpn.service", name))
+    if renew_daemon:
+        transaction.systemctl("start", unit_name("pia-pf-daemon.service", name))
+    elif forward:
+        transaction.systemctl("start", unit_name("pia-pf-renew.timer", name))
+    if reconnect_at_boot:
+        # the reconnect unit starts pia-vpn.service itself
+        transaction.systemctl("disable", unit_name("pia-vpn.service", name), check=False)
+        transaction.systemctl("enable", unit_name("pia-reconnect.service", name))
+    elif enable:
+        transaction.systemctl("enable", unit_name("pia-vpn.service", name))
+    if not args.dry_run:
+        # starting pia-vpn.service runs `refresh`, which must see this
+        # connection (and that it is new) rather than an older saved one
+        try:
+            os.remove(saved_status_path(name))
+        except FileNotFoundError:
+            pass
+        status['connection']['connected_at'] = time.time()
+        save_status(status, name)
     try:
-        config, status = configure(
-            token,
-            args.region,
-            args.hostname,
-            not args.no_disable_ipv6
-        )
-    except KeyAddFailure as exc:
-        print("Failed to add key to server. Response was:", file=sys.stderr)
-        print(f"{exc.reponse}", file=sys.stderr)
+        with trace.span('apply_transaction', steps=len(transaction.steps)):
+            transaction.apply(dry_run=args.dry_run)
+    except ApplyFailure as exc:
+        if not args.dry_run:
+            os.remove(status_path(name))
+        print(f"Failed to start connection: {exc}", file=sys.stderr)
         print("Exiting.", file=sys.stderr)
         return
-    else:
-        print("Successfully added WireGuard key to server")
-
-    subprocess.run(["sudo", "mkdir", "-p", "/etc/wireguard"])
-    subprocess.run(
-        ["sudo", "tee", "/etc/wireguard/pia.conf"],
-        input=config.encode('utf-8'),
-        stdout=subprocess.DEVNULL,
-    )
-
-    service_template = jinja_env.get_template("pia-vpn.service.jinja")
-    service = service_template.render(forward_port=args.forward_port)
-    subprocess.run(
-        ["sudo", "tee", "/etc/systemd/system/pia-vpn.service"],
-        input=service.encode('utf-8'),
-        stdout=subprocess.DEVNULL,
-    )
-    subprocess.run(["sudo", "systemctl", "start", "pia-vpn.service"])
+    if args.dry_run:
+        return
 
     try:
-        if args.forward_port or args.request_new_port:
-            timer = jinja_env.get_template("pia-pf-renew.timer").render()
-            timer_service = jinja_env.get_template("pia-pf-renew.service.jinja").render(
-                user=getpass.getuser(),
-                pia_service=os.path.join(sysconfig.get_path("scripts"), "pia-service"),
-            )
-            subprocess.run(
-                ["sudo", "tee", "/etc/systemd/system/pia-pf-renew.timer"],
-                input=timer.encode('utf-8'),
-                stdout=subprocess.DEVNULL,
-            )
-            subprocess.run(
-                ["sudo", "tee", "/etc/systemd/system/pia-pf-renew.service"],
-                input=timer_service.encode('utf-8'),
-                stdout=subprocess.DEVNULL,
-            )
-            subprocess.run(["sudo", "systemctl", "start", "pia-pf-renew.timer"])
-
-            authorities = {}
-            authority_file = os.path.join(package_dir, "port_authority.toml")
-            if os.path.exists(authority_file):
-                with open(authority_file, 'r') as f:
-                    authorities = toml.load(f)['authority']
-            if args.forward_port and authorities:
-                # get most recent authority
-                authority = max(authorities, key=lambda auth: auth['expires_at'])
-                # check expiration
-                # PIA provides expiration dates to ns precision, but `datetime`
-                # doesn't know how to handle that, and the relevant clocks aren't
-                # that accurate anyway, so truncate at the us level.
-                expiration = datetime.strptime(
-                    authority['expires_at'][:26], '%Y-%m-%dT%H:%M:%S.%f'
-                )
-                if datetime.utcnow() >= expiration:
-                    print(f"Authority for port {authority['port']} is expired")
-                    print("Requesting new forwarded port")
-                    authority = {'token': token}
-                else:
-                    print(f"Attempting to bind existing port {authority['port']}")
-            else:
-                authority = {'token': token}
-                print("Requesting new forwarded port")
-
+        if forward:
+            with trace.span('choose_authority'):
+                authority = choose_authority(status, token, reuse=args.forward_port)
             status = forward_port(status, authority)
+        status['connection']['connected_at'] = time.time()
+        status['connection']['connect_duration'] = round(time.monotonic() - started, 3)
     finally:
         # make sure to write the status file even if we hit an exception
         # during port forwarding somewhere
-        old_umask = os.umask(0o177)
-        with open(os.path.join(package_dir, 'status.toml'), 'w') as f:
-            toml.dump(status, f)
-        os.umask(old_umask)
+        with trace.span('save_status'):
+            save_status(status, name)
+
+def stop_connection(transaction, name=default_name):
+    """
+    Add the operations needed to stop a PIA connection (and the port
+    forward renewal timer or daemon, if there is one) to a privileged
+    transaction.
+    """
+    transaction.systemctl("stop", unit_name("pia-pf-renew.timer", name), check=False)
+    transaction.systemctl("stop", unit_name("pia-pf-daemon.service", name), check=False)
+    transaction.systemctl("stop", unit_name("pia-vpn.service", name))
 
 def disconnect(args):
     """
     Disconnect from PIA.
     """
+    name = check_name(args.name)
+    transaction = Transaction()
+    stop_connection(transaction, name)
     try:
-        with open(os.path.join(package_dir, 'status.toml'), 'r') as f:
-            status = toml.load(f)
-    except FileNotFoundError:
-        pass
+        transaction.apply(dry_run=args.dry_run)
+    except ApplyFailure as exc:
+        print(f"Failed to stop connection: {exc}", file=sys.stderr)
+        return
+    if not args.dry_run:
+        # keep the status around, so the connection can be restored quickly
+        # with `reconnect`
+        os.replace(status_path(name), saved_status_path(name))
+
+def mtu_setting(status):
+    """
+    The `mtu` argument to `configure()` that recreates the MTU choice of the
+    connection described by `status`: the same value if it was given
+    explicitly, and otherwise a fresh discovery.
+    """
+    mtu = status.get('mtu', {})
+    if mtu.get('method') == 'manual':
+        return mtu['value']
+    return 'auto'
+
+def fallback_args(args, status):
+    """
+    Arguments for `connect()` that recreate the connection described by
+    `status` from scratch, in the same region and with the same options.
+    """
+    name = status.get('interface', default_name)
+    routing = status.get('routing', {})
+    return argparse.Namespace(
+        name=name,
+        region=status['server']['region_id'],
+        hostname=None,
+        forward_port='port_forward' in status,
+        request_new_port=False,
+        no_disable_ipv6=not status['connection']['disable_ipv6'],
+        fastest=args.fastest,
+        renew_daemon=os.path.exists(
+            f"/etc/systemd/system/{unit_name('pia-pf-daemon.service', name)}"
+        ),
+        dry_run=args.dry_run,
+        source=routing.get('sources', []),
+        mark=routing.get('marks', []),
+        hedge=args.hedge,
+        mtu=mtu_setting(status),
+    )
+
+@trace.timed('reconnect')
+def reconnect(args):
+    """
+    Restore a previous connection by bringing up its saved WireGuard
+    configuration, which only takes a handshake if the server still knows
+    our key. If there is no handshake within `--deadline` seconds, fall
+    back to connecting from scratch to the same region, with the same
+    options. The unit's `refresh` is skipped, so the deadline starts
+    counting right away.
+    """
+    started = time.monotonic()
+    name = check_name(args.name)
+    status = load_status(name)
+    if status is None:
+        status = load_saved_status(name)
+    if status is None:
+        print("No previous connection to restore, use connect instead.", file=sys.stderr)
+        return
+    if 'region_id' not in status['server']:
+        print("Previous region unknown, use connect instead.", file=sys.stderr)
+        return
+    if subprocess.run(["ip", "link", "show", name], capture_output=True).returncode == 0:
+        print(f'Device "{name}" already exists, aborting.', file=sys.stderr)
+        return
+
+    server = status['server']
+    print(f"Restoring connection to {server['region']} ({server['cn']})")
+    transaction = Transaction()
+    transaction.systemctl("start", unit_name("pia-vpn.service", name))
+    timer_unit = unit_name("pia-pf-renew.timer", name)
+    if 'port_forward' in status and os.path.exists(f"/etc/systemd/system/{timer_unit}"):
+        transaction.systemctl("start", timer_unit)
+    marker = reconnect_marker_path(name)
+    try:
+        if not args.dry_run:
+            # the handshake deadline below already covers a saved key or
+            # server that is no longer accepted, so don't let the unit's
+            # refresh hold up starting the tunnel
+            old_umask = os.umask(0o177)
+            try:
+                open(marker, 'w').close()
+            finally:
+                os.umask(old_umask)
+        with trace.span('start_tunnel'):
+            transaction.apply(dry_run=args.dry_run)
+    except ApplyFailure as exc:
+        # e.g. the configuration is gone
+        print(f"Failed to start saved connection: {exc}", file=sys.stderr)
+        handshake = False
+    else:
+        if args.dry_run:
+            return
+        with trace.span('wait_handshake') as fields:
+            handshake = fields['handshake'] = wait_for_handshake(name, args.deadline)
+    finally:
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+    if handshake is False:
+        print(f"No handshake with {server['cn']} within {args.deadline} s,"
+              " connecting from scratch")
+        transaction = Transaction()
+        stop_connection(transaction, name)
+        try:
+            transaction.apply()
+        except ApplyFailure:
+            pass
+        with trace.span('fallback'):
+            connect(fallback_args(args, status))
+        return
+    # the unit may have refreshed the saved configuration before starting
+    refreshed = load_status(name) or load_saved_status(name)
+    if refreshed is not None:
+        status = refreshed
+        server = status['server']
+    if handshake is None:
+        print("Unable to check for a handshake (`sudo -n wg` failed),"
+              " assuming the tunnel is up", file=sys.stderr)
     else:
+        print(f"Handshake completed after {time.monotonic() - started:.1f} s")
+
+    try:
         if 'port_forward' in status:
-            subprocess.run(["sudo", "systemctl", "stop", "pia-pf-renew.timer"])
-    subprocess.run(["sudo", "systemctl", "stop", "pia-vpn.service"])
-    os.remove(os.path.join(package_dir, 'status.toml'))
+            if is_expired(status['port_forward']):
+                print("Forwarded port has expired")
+                authority = choose_authority(status, get_token())
+            else:
+                authority = {
+                    'payload': status['port_forward']['payload'],
+                    'signature': status['port_forward']['signature'],
+                }
+            status = forward_port(status, authority, wait=args.deadline)
+        status['connection']['connected_at'] = time.time()
+        status['connection']['connect_duration'] = round(time.monotonic() - started, 3)
+    finally:
+        save_status(status, name)
+        try:
+            os.remove(saved_status_path(name))
+        except FileNotFoundError:
+            pass
+
+def refresh_connection(status, name=default_name, fastest=False, hedge=0.5):
+    """
+    Register the key of a saved connection again, with the same server if
+    it is still listed in its region and accepts connections, and otherwise
+    with another server in the region. The key itself is only replaced if
+    PIA no longer accepts it.
+
+    Parameters
+    ----------
+    status: Saved status of the connection
+    name: Name of the tunnel
+    fastest: Whether to choose the fastest other server in the region, if
+             the saved server can't be used (rather than a random one)
+    hedge: Hedging delay (see `hedged_add_key()`) used if the saved server
+           can't be used
+
+    Returns
+    -------
+    config: WireGuard configuration file for the refreshed connection
+    status: Dictionary representing the refreshed connection status
+    """
+    server = status['server']
+    region = server['region_id']
+    with trace.span('check_server', server=server['cn']) as fields:
+        index = get_index()
+        listed = (server['cn'] in index['servers']
+                  and index['servers'][server['cn']] == region)
+        fields['listed'] = listed
+        if listed:
+            ip = find_server(server['cn'], index)[1]['ip']
+            fields['reachable'] = tcp_rtt(ip, timeout=2.0) is not None
+    if not listed:
+        print(f"{server['cn']} is no longer listed in {server['region']},"
+              " choosing another server")
+        hostname = None
+    elif not fields['reachable']:
+        print(f"{server['cn']} isn't responding, choosing another server")
+        hostname = None
+    else:
+        hostname = server['cn']
 
+    keypair = (status['wireguard']['key'], status['wireguard']['pubkey'])
+    token = get_token()
+    for attempt in range(2):
+        try:
+            return configure(
+                token,
+                region,
+                hostname,
+                status['connection']['disable_ipv6'],
+                fastest,
+                keypair=keypair,
+                name=name,
+                sources=status.get('routing', {}).get('sources', []),
+                marks=status.get('routing', {}).get('marks', []),
+                hedge=hedge,
+                mtu=mtu_setting(status),
+            )
+        except KeyAddFailure:
+            if attempt:
+                raise
+            # the cached token may have been revoked, or the key forgotten
+            print("Key was rejected, retrying with a new token and key")
+            invalidate_token()
+            token = get_token(use_cache=False)
+            keypair = None
+
+@trace.timed('refresh')
+def refresh(args):
+    """
+    Bring a saved connection up to date before its WireGuard interface is
+    brought up (run by pia-vpn.service as an ExecStartPre command, as root).
+    Using the cached token and server list where possible, the key is
+    registered with the server again, or with another server in the region
+    if the saved one has gone, and the WireGuard configuration is rewritten
+    if anything changed. If this takes longer than `--budget` seconds, the
+    saved configuration is used as it is. Nothing is done when the unit was
+    started by `reconnect`, which falls back to connecting from scratch
+    itself.
+    """
+    name = check_name(args.name)
+    try:
+        marker_age = time.time() - os.stat(reconnect_marker_path(name)).st_mtime
+    except FileNotFoundError:
+        marker_age = None
+    # an older marker was left behind by a reconnect that didn't finish
+    if marker_age is not None and marker_age < refresh_min_age:
+        print("Started by reconnect, not refreshing")
+        return
+    path = status_path(name)
+    status = load_status(name)
+    if status is None:
+        path = saved_status_path(name)
+        status = load_saved_status(name)
+    if status is None or 'region_id' not in status['server']:
+        print("No saved connection to refresh")
+        return
+    connected_at = status['connection'].get('connected_at')
+    if connected_at is not None and time.time() - connected_at < refresh_min_age:
+        print("Connection was set up recently, not refreshing")
+        return
+
+    deadline = time.monotonic() + args.budget
+    abandoned = threading.Event()
+    # held while the configuration and status are written, so that giving
+    # up doesn't leave one of them updated but not the other
+    committing = threading.Lock()
+    def worker():
+        try:
+            config, new_status = refresh_connection(status, name, args.fastest)
+        except AuthFailure as exc:
+            print("PIA authentication failed. Received response:", file=sys.stderr)
+            print(exc.response, file=sys.stderr)
+            return
+        except KeyAddFailure as exc:
+            print("Failed to add key to server. Response was:", file=sys.stderr)
+            print(f"{exc.response}", file=sys.stderr)
+            return
+        except Exception as exc:
+            # e.g. no network, or no stored credentials to get a token with
+            print(f"Refresh failed: {exc!r}", file=sys.stderr)
+            return
+        with committing:
+            if abandoned.is_set():
+                return
+            commit(config, new_status)
+
+    def commit(config, new_status):
+        conf_path = f"/etc/wireguard/{name}.conf"
+        try:
+            with open(conf_path) as f:
+                changed = f.read() != config
+        except OSError:
+            changed = True
+        if changed:
+            transaction = Transaction()
+            transaction.write(conf_path, config, mode=0o600)
+            try:
+                with trace.span('write_config'):
+                    transaction.apply(dry_run=args.dry_run)
+            except ApplyFailure as exc:
+                print(f"Failed to update configuration: {exc}", file=sys.stderr)
+                return
+        if args.dry_run:
+            return
+        print(f"Refreshed connection to {new_status['server']['region']}"
+              f" ({new_status['server']['cn']})"
+              f"{'' if changed else ', configuration unchanged'}")
+        # a port from another server is replaced when it is next renewed
+        for key in ('port_forward', 'latency'):
+            if key in status and key not in new_status:
+                new_status[key] = status[key]
+        new_status['connection']['connected_at'] = time.time()
+        save_status(new_status, name, path)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        thread.join(max(deadline - time.monotonic(), 0))
+        if thread.is_alive():
+            with committing:
+                abandoned.set()
+            print(f"Refresh took longer than {args.budget} s,"
+                  " using the saved configuration", file=sys.stderr)
+    finally:
+        restore_ownership()
+
+def switch_server(region=None, hostname=None, fastest=False, dry_run=False,
+                  name=default_name):
+    """
+    Move an active connection to another server without tearing down the
+    pia interface. The current public key is registered with the new server,
+    and only the peer, endpoint and interface address are changed in place
+    (via the ExecReload of pia-vpn.service, which runs `wg syncconf`), so
+    routing rules and DNS settings stay in place.
+
+    Parameters
+    ----------
+    region: PIA region id to switch to (default: the current region)
+    hostname: (Optional) Hostname of the server to switch to
+    fastest: Whether to choose the server in the region with the lowest latency
+    dry_run: Print the privileged operations instead of running them
+    name: Name of the tunnel to switch
+
+    Returns
+    -------
+    status: Dictionary representing the new connection status, or `None`
+            if switching failed
+    """
+    old_status = load_status(name)
+    if old_status is None:
+        print("Not connected", file=sys.stderr)
+        return None
+    if subprocess.run(["ip", "link", "show", name], capture_output=True).returncode != 0:
+        print(f'Device "{name}" does not exist, use connect instead.', file=sys.stderr)
+        return None
+    if region is None:
+        if 'region_id' not in old_status['server']:
+            print("Current region unknown, please specify one.", file=sys.stderr)
+            return None
+        region = old_status['server']['region_id']
+    # the tunnel is still up, and may be why we are switching (see
+    # `monitor`), so reach the new server the way WireGuard does
+    socket_options = bypass_socket_options(old_status['server']['ip'], routing_table(name))
+
+    try:
+        token = get_token()
+        keypair = (old_status['wireguard']['key'], old_status['wireguard']['pubkey'])
+        config, status = configure(
+            token,
+            region,
+            hostname,
+            old_status['connection']['disable_ipv6'],
+            fastest,
+            keypair=keypair,
+            name=name,
+            sources=old_status.get('routing', {}).get('sources', []),
+            marks=old_status.get('routing', {}).get('marks', []),
+            # `wg syncconf` can't change the MTU of the live interface, and
+            # probing now would measure the path through the tunnel
+            mtu=old_status.get('mtu', {}).get('value') or path_mtu.interface_mtu(name),
+            socket_options=socket_options,
+        )
+        if 'mtu' in old_status:
+            status['mtu'] = old_status['mtu']
+    except AuthFailure as exc:
+        print("PIA authentication failed. Received response:")
+        print(exc.response)
+        print("Exiting.")
+        return None
+    except KeyAddFailure as exc:
+        print("Failed to add key to server. Response was:", file=sys.stderr)
+        print(f"{exc.response}", file=sys.stderr)
+        print("Exiting.", file=sys.stderr)
+        return None
+    print(f"Switching to {status['server']['region']} ({status['server']['cn']})")
+
+    old_ip = old_status['wireguard']['ip']
+    new_ip = status['wireguard']['ip']
+    transaction = Transaction()
+    transaction.write(f"/etc/wireguard/{name}.conf", config, mode=0o600)
+    # `wg syncconf` updates the peer and endpoint, but not the address
+    transaction.systemctl("reload", unit_name("pia-vpn.service", name))
+    if new_ip != old_ip:
+        transaction.command("ip", "-4", "address", "add", f"{new_ip}/32", "dev", name)
+        transaction.command("ip", "-4", "address", "del", f"{old_ip}/32", "dev", name,
+                            check=False)
+        if name != default_name:
+            # traffic from the tunnel's own address is routed through it
+            table = str(status['routing']['table'])
+            transaction.command("ip", "-4", "rule", "add", "priority", "6060",
+                                "from", new_ip, "table", table)
+            transaction.command("ip", "-4", "rule", "delete", "from", old_ip,
+                                "table", table, check=False)
+    dns_changed = status['connection']['dns_servers'] != old_status['connection']['dns_servers']
+    if name == default_name and dns_changed:
+        transaction.command("resolvectl", "dns", name, *status['connection']['dns_servers'])
+    try:
+        transaction.apply(dry_run=dry_run)
+    except ApplyFailure as exc:
+        print(f"Failed to switch servers: {exc}", file=sys.stderr)
+        return None
+    if dry_run:
+        return status
+
+    try:
+        if 'port_forward' in old_status:
+            # forwarded ports are specific to the server that issued them
+            authority = choose_authority(status, token)
+            status = forward_port(status, authority)
+    finally:
+        save_status(status, name)
+    return status
+
+def switch(args):
+    """
+    Move an active connection to another server without disconnecting.
+    """
+    switch_server(args.region, args.hostname, args.fastest, args.dry_run,
+                  check_name(args.name))
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import os
+import random
+import signal
+import sys
+import time
+from datetime import datetime
+
+from .port_forward import rebind
+from .status import socket_path
+from .tunnels import check_name, load_status
+package_dir = os.path.dirname(__file__)
+
+# Renew every 15 minutes, minus up to 10% random jitter. After a failure,
+# retry after 30 seconds, doubling up to a maximum of 5 minutes.
+renew_interval = 15*60
+renew_jitter = 0.1
+retry_initial = 30
+retry_max = 5*60
+
+class RenewalDaemon:
+    """
+    Long-running process that keeps a forwarded port bound, and answers
+    status queries over a Unix socket.
+
+    Binding requests are made from a worker thread, but always through the
+    same `requests` session (see `transport.get_session()`), so the
+    connection to the server stays warm between renewals.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.last_attempt = None
+        self.last_success = None
+        self.renewals = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.next_renewal = None
+
+    def next_delay(self, success):
+        """
+        Time to wait before the next renewal attempt, in seconds.
+        """
+        if success:
+            return renew_interval * (1 - random.uniform(0, renew_jitter))
+        delay = retry_initial * 2**(self.consecutive_failures - 1)
+        return min(delay, retry_max) * random.uniform(0.8, 1.0)
+
+    def initial_delay(self):
+        """
+        Time to wait before the first renewal attempt: the remainder of the
+        renewal interval since the port was last renewed, if it is known.
+        """
+        status = load_status(self.name)
+        try:
+            last_renewed = datetime.strptime(
+                status['port_forward']['last_renewed'], "%Y-%m-%dT%H:%M:%S.%fZ"
+            )
+        except (TypeError, KeyError, ValueError):
+            return retry_initial
+        elapsed = (datetime.utcnow() - last_renewed).total_seconds()
+        return max(self.next_delay(success=True) - elapsed, 0)
+
+    async def renew_loop(self):
+        loop = asyncio.get_event_loop()
+        delay = self.initial_delay()
+        while True:
+            self.next_renewal = time.time() + delay
+            await asyncio.sleep(delay)
+            # re-read status each time, in case we have reconnected since
+            status = load_status(self.name)
+            if status is None or 'port_forward' not in status:
+                # nothing to renew (yet); check again later
+                delay = retry_initial
+                continue
+            self.last_attempt = time.time()
+            try:
+                success = await loop.run_in_executor(None, rebind, status)
+            except Exception as exc:
+                print(f"Renewal failed: {exc!r}", file=sys.stderr)
+                success = False
+            if success:
+                self.last_success = time.time()
+                self.renewals += 1
+                self.consecutive_failures = 0
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+            sys.stdout.flush()
+            delay = self.next_delay(success)
+
+    def snapshot(self):
+        """
+        Current connection and renewal state, as sent to status queries.
+        """
+        status = load_status(self.name)
+        if status is not None:
+            # never hand out the private key
+            status.get('wireguard', {}).pop('key', None)
+        return {
+            'status': status,
+            'daemon': {
+                'pid': os.getpid(),
+                'started_at': self.started_at,
+                'last_attempt': self.last_attempt,
+                'last_success': self.last_success,
+                'next_renewal': self.next_renewal,
+                'renewals': self.renewals,
+                'failures': self.failures,
+            },
+        }
+
+    async def handle_query(self, reader, writer):
+        try:
+            await reader.readline()
+            writer.write(json.dumps(self.snapshot()).encode('utf-8') + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def run(self):
+        path = socket_path(self.name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        old_umask = os.umask(0o177)
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_unix_server(self.handle_query, path=path)
+            )
+        finally:
+            os.umask(old_umask)
+        renewal = loop.create_task(self.renew_loop())
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, renewal.cancel)
+        try:
+            loop.run_until_complete(renewal)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+            os.remove(path)
+
+def daemon(args):
+    """
+    Run the port forward renewal daemon until interrupted.
+    """
+    name = check_name(args.name)
+    print(f"Renewal daemon listening on {socket_path(name)}")
+    sys.stdout.flush()
+    RenewalDaemon(name).run()
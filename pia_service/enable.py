@@ -1,36 +1,47 @@
-import subprocess
-import toml
+import sys
 import os
-from .connect import connect, disconnect
+from .connect import connect, stop_connection
+from .privileged import Transaction, ApplyFailure
+from .tunnels import (check_name, status_path, saved_status_path, unit_name,
+                      release_routing_table)
+from . import trace
 package_dir = os.path.dirname(__file__)
 
+@trace.timed('enable')
 def enable(args):
     """
     Create a persistent PIA WireGuard connection to the specified region
     by enabling a systemd service.
     """
-    # first connect, then enable
-    connect(args)
-
-    subprocess.run(["sudo", "systemctl", "enable", "pia-vpn"])
+    connect(args, enable=True)
 
 def disable(args):
     """
     Disable the PIA systemd service and remove associated files.
     """
-    # first disconnect, then disable
-    disconnect(args)
-
+    name = check_name(args.name)
+    transaction = Transaction()
+    stop_connection(transaction, name)
+    transaction.systemctl("disable", unit_name("pia-pf-renew.timer", name), check=False)
+    transaction.remove(f"/etc/systemd/system/{unit_name('pia-pf-renew.timer', name)}")
+    transaction.remove(f"/etc/systemd/system/{unit_name('pia-pf-renew.service', name)}")
+    transaction.remove(f"/etc/systemd/system/{unit_name('pia-pf-daemon.service', name)}")
+    transaction.systemctl("disable", unit_name("pia-reconnect.service", name), check=False)
+    transaction.remove(f"/etc/systemd/system/{unit_name('pia-reconnect.service', name)}")
+    transaction.systemctl("disable", unit_name("pia-vpn.service", name), check=False)
+    transaction.remove(f"/etc/systemd/system/{unit_name('pia-vpn.service', name)}")
+    transaction.remove(f"/etc/wireguard/{name}.conf")
+    transaction.systemctl("daemon-reload")
     try:
-        with open(os.path.join(package_dir, 'status.toml'), 'r') as f:
-            status = toml.load(f)
-    except FileNotFoundError:
-        pass
-    else:
-        if 'port_forward' in status:
-            subprocess.run(["sudo", "systemctl", "disable", "pia-pf-renew.timer"])
-            subprocess.run(["sudo", "rm", "/etc/systemd/system/pia-pf-renew.timer"])
-            subprocess.run(["sudo", "rm", "/etc/systemd/system/pia-pf-renew.service"])
-    subprocess.run(["sudo", "systemctl", "disable", "pia-vpn"])
-    subprocess.run(["sudo", "rm", "/etc/systemd/system/pia-vpn.service"])
-    subprocess.run(["sudo", "rm", "/etc/wireguard/pia.conf"])
+        transaction.apply(dry_run=args.dry_run)
+    except ApplyFailure as exc:
+        print(f"Failed to disable connection: {exc}", file=sys.stderr)
+        return
+    if args.dry_run:
+        return
+    for path in [status_path(name), saved_status_path(name)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    release_routing_table(name)
@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from .tunnels import connected_tunnels, load_status
+from .telemetry import read_interface
+from .authority_store import expiration
+from .mtu import mismatch
+
+def utc_timestamp(dt):
+    """
+    Convert a naive `datetime` in UTC to seconds since the epoch.
+    """
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class Metrics:
+    """
+    A set of metric families, rendered in the Prometheus text format
+    (as also read by node-exporter's textfile collector).
+    """
+    def __init__(self):
+        # name -> (type, help, list of (labels, value) samples)
+        self.families = {}
+
+    def add(self, name, kind, help, value, **labels):
+        family = self.families.setdefault(name, (kind, help, []))
+        family[2].append((labels, value))
+
+    def gauge(self, name, help, value, **labels):
+        self.add(name, 'gauge', help, value, **labels)
+
+    def counter(self, name, help, value, **labels):
+        self.add(name, 'counter', help, value, **labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, samples) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if labels:
+                    label_text = ','.join(f'{key}="{escape(value)}"' for key, value in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+def collect():
+    """
+    Collect metrics for all connected tunnels from their status files and
+    live interfaces. This only reads small local files and runs `wg show`
+    once per tunnel, so it is cheap enough to run every few seconds.
+    """
+    started = time.monotonic()
+    metrics = Metrics()
+    for name in connected_tunnels():
+        status = load_status(name)
+        if status is None:
+            continue
+        sample = read_interface(name)
+        server = status['server']
+        metrics.gauge('pia_tunnel_up', "Whether the tunnel's WireGuard interface exists",
+                      int(sample is not None), tunnel=name)
+        metrics.gauge('pia_tunnel_info', "Server and region the tunnel is connected to",
+                      1, tunnel=name, region=server['region'],
+                      region_id=server.get('region_id', ''), server=server['cn'],
+                      server_ip=server['ip'])
+        connection = status['connection']
+        if 'connected_at' in connection:
+            metrics.gauge('pia_connected_timestamp_seconds',
+                          "Time the tunnel was connected", connection['connected_at'],
+                          tunnel=name)
+        if 'connect_duration' in connection:
+            metrics.gauge('pia_connect_duration_seconds',
+                          "Time taken to set up the tunnel", connection['connect_duration'],
+                          tunnel=name)
+        if sample is not None:
+            metrics.counter('pia_receive_bytes_total', "Bytes received through the tunnel",
+                            sample['rx_bytes'], tunnel=name)
+            metrics.counter('pia_transmit_bytes_total', "Bytes sent through the tunnel",
+                            sample['tx_bytes'], tunnel=name)
+            # the handshake time is unknown if `wg show` isn't available
+            if sample['latest_handshake']:
+                metrics.gauge('pia_handshake_age_seconds',
+                              "Time since the latest WireGuard handshake",
+                              round(sample['time'] - sample['latest_handshake'], 3),
+                              tunnel=name)
+        if 'mtu' in status:
+            metrics.gauge('pia_tunnel_mtu', "MTU configured for the tunnel interface",
+                          status['mtu']['value'], tunnel=name)
+            if sample is not None:
+                metrics.gauge('pia_tunnel_mtu_mismatch',
+                              "Whether the tunnel's MTU looks wrong for its interface"
+                              " or the route to the server",
+                              int(mismatch(status) is not None), tunnel=name)
+        if 'port_forward' in status:
+            port_forward = status['port_forward']
+            metrics.gauge('pia_forwarded_port', "Port forwarded to this host",
+                          port_forward['port'], tunnel=name)
+            metrics.gauge('pia_port_expiry_timestamp_seconds',
+                          "Time at which the forwarded port expires",
+                          utc_timestamp(expiration(port_forward)), tunnel=name)
+            last_renewed = datetime.strptime(
+                port_forward['last_renewed'], "%Y-%m-%dT%H:%M:%S.%fZ"
+            )
+            metrics.gauge('pia_port_last_renewal_timestamp_seconds',
+                          "Time the forwarded port was last bound successfully",
+                          utc_timestamp(last_renewed), tunnel=name)
+            metrics.counter('pia_port_renewals_total',
+                            "Successful renewals of the forwarded port",
+                            port_forward.get('renewals', 0), tunnel=name)
+            metrics.counter('pia_port_renewal_failures_total',
+                            "Failed renewals of the forwarded port",
+                            port_forward.get('renewal_failures', 0), tunnel=name)
+    metrics.gauge('pia_exporter_collect_duration_seconds',
+                  "Time taken to collect these metrics",
+                  round(time.monotonic() - started, 6))
+    return metrics
+
+def write_textfile(path, content):
+    """
+    Atomically replace a textfile collector file, so node-exporter never
+    sees a partly written file.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def serve(address):
+    """
+    Serve metrics at http://<address>/metrics, collecting them afresh for
+    each request.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = collect().render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    host, _, port = address.rpartition(':')
+    server = HTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+    print(f"Serving metrics on http://{host or '127.0.0.1'}:{port}/metrics", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def export(args):
+    """
+    Export tunnel and port forwarding metrics in the Prometheus text format:
+    to a file for node-exporter's textfile collector (once, or every
+    `--interval` seconds), over HTTP, or else on stdout.
+    """
+    if args.listen is not None:
+        serve(args.listen)
+        return
+    if args.textfile is None:
+        sys.stdout.write(collect().render())
+        return
+    while True:
+        write_textfile(args.textfile, collect().render())
+        if args.interval is None:
+            return
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            return
@@ -0,0 +1,143 @@
+import base64
+import fcntl
+import os
+import secrets
+import threading
+import toml
+package_dir = os.path.dirname(__file__)
+pool_path = os.path.join(package_dir, 'keypool.toml')
+
+# Curve25519 parameters (RFC 7748)
+P = 2**255 - 19
+A24 = 121665
+
+def x25519(scalar, u):
+    """
+    Compute the X25519 function of RFC 7748 on 32-byte strings.
+
+    Parameters
+    ----------
+    scalar: Scalar (e.g. private key), as 32 bytes
+    u: u-coordinate of a point (e.g. the base point), as 32 bytes
+
+    Returns
+    -------
+    result: u-coordinate of the resulting point, as 32 bytes
+    """
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    k = int.from_bytes(k, 'little')
+    x1 = int.from_bytes(u, 'little') & ((1 << 255) - 1)
+
+    # Montgomery ladder
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = k_t
+
+        a = (x2 + z2) % P
+        aa = a * a % P
+        b = (x2 - z2) % P
+        bb = b * b % P
+        e = (aa - bb) % P
+        c = (x3 + z3) % P
+        d = (x3 - z3) % P
+        da = d * a % P
+        cb = c * b % P
+        x3 = (da + cb) ** 2 % P
+        z3 = x1 * (da - cb) ** 2 % P
+        x2 = aa * bb % P
+        z2 = e * (aa + A24 * e) % P
+    if swap:
+        x2, x3 = x3, x2
+        z2, z3 = z3, z2
+
+    return (x2 * pow(z2, P - 2, P) % P).to_bytes(32, 'little')
+
+def generate_keypair():
+    """
+    Create a WireGuard private key and the corresponding public key
+    in-process, in the same base64 format as `wg genkey` and `wg pubkey`.
+    """
+    key = bytearray(secrets.token_bytes(32))
+    # clamp the private key, as `wg genkey` does
+    key[0] &= 248
+    key[31] &= 127
+    key[31] |= 64
+    key = bytes(key)
+    pubkey = x25519(key, (9).to_bytes(32, 'little'))
+    return base64.b64encode(key).decode('ascii'), base64.b64encode(pubkey).decode('ascii')
+
+def get_pool_size():
+    """
+    Get the configured size of the pre-generated key pool from the
+    environment variable PIA_KEY_POOL_SIZE (0, the default, disables it).
+    """
+    try:
+        return max(int(os.environ['PIA_KEY_POOL_SIZE']), 0)
+    except (KeyError, ValueError):
+        return 0
+
+def update_pool(update):
+    """
+    Apply `update` to the list of keypairs in the pool while holding a lock
+    on the pool file, so that concurrent processes never hand out the same
+    keypair. The pool file is only readable by its owner.
+
+    Parameters
+    ----------
+    update: Function taking the list of pooled keypairs, modifying it in
+            place, and returning a value to be passed back to the caller.
+    """
+    old_umask = os.umask(0o177)
+    try:
+        with open(pool_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            keypairs = toml.loads(f.read()).get('keypair', [])
+            result = update(keypairs)
+            f.seek(0)
+            f.truncate()
+            toml.dump({'keypair': keypairs}, f)
+    finally:
+        os.umask(old_umask)
+    return result
+
+def refill_pool(size=None):
+    """
+    Generate keypairs until the pool contains `size` of them.
+    """
+    if size is None:
+        size = get_pool_size()
+    def refill(keypairs):
+        while len(keypairs) < size:
+            key, pubkey = generate_keypair()
+            keypairs.append({'key': key, 'pubkey': pubkey})
+    update_pool(refill)
+
+def create_keypair():
+    """
+    Get a WireGuard private key and the corresponding public key.
+
+    If the key pool is enabled (see `get_pool_size()`), a pre-generated
+    keypair is taken from the pool, and the pool is refilled in a background
+    thread. Otherwise, a new keypair is generated.
+    """
+    size = get_pool_size()
+    if not size:
+        return generate_keypair()
+    try:
+        keypair = update_pool(lambda keypairs: keypairs.pop() if keypairs else None)
+    except OSError:
+        return generate_keypair()
+    threading.Thread(target=refill_pool, args=(size,)).start()
+    if keypair is None:
+        return generate_keypair()
+    return keypair['key'], keypair['pubkey']
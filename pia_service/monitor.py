@@ -0,0 +1,150 @@
+import json
+import os
+import sys
+import time
+
+from .tunnels import check_name, load_status, routing_table
+from .telemetry import read_interface
+from .probe import tcp_rtt, probe_servers, bypass_socket_options
+from .server_info import get_regions
+from .connect import switch_server
+package_dir = os.path.dirname(__file__)
+failover_log_path = os.path.join(package_dir, 'failovers.jsonl')
+
+def check_health(status, sample, previous, args):
+    """
+    Check the connected server against the health thresholds.
+
+    Parameters
+    ----------
+    status: Dictionary representing connection status
+    sample: Current interface counters (see `telemetry.read_interface()`)
+    previous: Interface counters from the previous check, or `None`
+    args: Monitor options (thresholds)
+
+    Returns
+    -------
+    problems: List of strings describing threshold violations (empty if
+              the connection looks healthy)
+    rtt: Probed round-trip time to the server in seconds, or `None`
+    """
+    problems = []
+    if sample is None:
+        return ["interface is down"], None
+    handshake = sample['latest_handshake']
+    if handshake is not None:
+        age = sample['time'] - handshake if handshake else None
+        if age is None or age > args.max_handshake_age:
+            problems.append(f"handshake age {age if age is None else round(age)} s"
+                            f" exceeds {args.max_handshake_age} s")
+    if previous is not None:
+        rx_delta = sample['rx_bytes'] - previous['rx_bytes']
+        tx_delta = sample['tx_bytes'] - previous['tx_bytes']
+        if tx_delta > 0 and rx_delta == 0:
+            problems.append("sent data but received nothing since last check")
+    rtt = tcp_rtt(status['server']['ip'], timeout=args.max_rtt / 1000)
+    if rtt is None:
+        problems.append(f"probe got no response within {args.max_rtt} ms")
+    return problems, rtt
+
+def rank_candidates(status, name):
+    """
+    Rank the other WireGuard servers in the current region by latency. The
+    probes are sent outside the tunnel, which may well be what has stopped
+    working.
+
+    Returns
+    -------
+    candidates: List of server common names, fastest first (servers that
+                didn't respond are left out)
+    """
+    regions = get_regions()
+    region = regions[status['server']['region_id']]
+    servers = [
+        server for server in region['servers']['wg']
+        if server['cn'] != status['server']['cn']
+    ]
+    socket_options = bypass_socket_options(status['server']['ip'], routing_table(name))
+    rtts = probe_servers(servers, socket_options=socket_options)
+    reachable = [cn for cn, rtt in rtts.items() if rtt is not None]
+    return sorted(reachable, key=lambda cn: rtts[cn])
+
+def record_failover(event):
+    """
+    Append a failover event to `failovers.jsonl`.
+    """
+    old_umask = os.umask(0o177)
+    try:
+        with open(failover_log_path, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+    finally:
+        os.umask(old_umask)
+
+def failover(status, problems, name):
+    """
+    Switch to the next-best server in the current region.
+
+    Returns
+    -------
+    status: New connection status, or `None` if no server could be used
+    """
+    started = time.monotonic()
+    event = {
+        'time': time.time(),
+        'tunnel': name,
+        'from': status['server']['cn'],
+        'region': status['server']['region_id'],
+        'problems': problems,
+    }
+    candidates = rank_candidates(status, name)
+    event['rank_duration'] = round(time.monotonic() - started, 3)
+    new_status = None
+    for cn in candidates:
+        print(f"Failing over to {cn}")
+        new_status = switch_server(status['server']['region_id'], cn, name=name)
+        if new_status is not None:
+            event['to'] = cn
+            event['port_forward'] = 'port_forward' in new_status
+            break
+    else:
+        event['to'] = None
+        print("No other server available, staying on current server", file=sys.stderr)
+    event['duration'] = round(time.monotonic() - started, 3)
+    record_failover(event)
+    return new_status
+
+def monitor(args):
+    """
+    Watch the health of the connected server, and fail over to the
+    next-best server in the same region once thresholds have been
+    exceeded on `--failures` consecutive checks.
+    """
+    name = check_name(args.name)
+    previous = None
+    failures = 0
+    while True:
+        status = load_status(name)
+        if status is None:
+            print("Not connected", file=sys.stderr)
+            return
+        if 'region_id' not in status['server']:
+            print("Current region unknown, reconnect to enable monitoring.",
+                  file=sys.stderr)
+            return
+        sample = read_interface(name)
+        problems, rtt = check_health(status, sample, previous, args)
+        previous = sample
+        if problems:
+            failures += 1
+            print(f"{status['server']['cn']}: {'; '.join(problems)}"
+                  f" ({failures}/{args.failures})", file=sys.stderr, flush=True)
+        else:
+            failures = 0
+        if failures >= args.failures:
+            if failover(status, problems, name) is not None:
+                previous = None
+            failures = 0
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            return
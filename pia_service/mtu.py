@@ -0,0 +1,187 @@
+import socket
+import subprocess
+import time
+from .probe import bypass_socket_options
+
+# Bytes added to each packet by WireGuard over IPv4: IPv4 header (20), UDP
+# header (8), WireGuard data header (16) and authentication tag (16)
+overhead = 60
+# wg-quick's default leaves room for an IPv6 outer header, which is what we
+# fall back on when the path couldn't be probed
+fallback_overhead = 80
+# Path MTUs tried when probing, largest first: Ethernet, PPPoE, and a few
+# common tunnel and cloud uplink values, down to the IPv6 minimum
+candidates = (1500, 1492, 1480, 1472, 1460, 1450, 1440, 1420, 1400,
+              1380, 1360, 1340, 1320, 1300, 1280)
+# Give up on probes that haven't been answered after this many seconds
+probe_timeout = 1.0
+
+def route_mtu(ip, mark=None):
+    """
+    Get the MTU of the route to `ip`, according to the kernel: the path MTU
+    it has learned from ICMP "fragmentation needed" messages if there is
+    one, and otherwise the MTU of the outgoing interface.
+
+    Parameters
+    ----------
+    ip: IP address of the destination
+    mark: Firewall mark to look the route up with (the mark WireGuard puts
+          on its own packets, so the tunnel itself isn't chosen)
+
+    Returns
+    -------
+    mtu: MTU in bytes, or `None` if it couldn't be determined
+    """
+    command = ["ip", "-o", "route", "get", ip]
+    if mark is not None:
+        command += ["mark", str(mark)]
+    try:
+        result = subprocess.run(command, capture_output=True)
+    except FileNotFoundError:
+        return None
+    if result.returncode != 0:
+        return None
+    fields = result.stdout.decode('utf-8').split()
+    if 'mtu' in fields:
+        return int(fields[fields.index('mtu') + 1])
+    if 'dev' not in fields:
+        return None
+    device = fields[fields.index('dev') + 1]
+    try:
+        with open(f'/sys/class/net/{device}/mtu') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def ping_options(ip, mark):
+    """
+    Options for `ping` that send its packets to `ip` outside a tunnel, as
+    if they carried the firewall mark `mark` (see
+    `probe.bypass_socket_options()`).
+    """
+    options = []
+    for level, option, value in bypass_socket_options(ip, mark):
+        if option == socket.SO_MARK:
+            options += ["-m", str(value)]
+        elif option == socket.SO_BINDTODEVICE:
+            options += ["-I", value.decode('utf-8')]
+    return options
+
+def probe_path_mtu(ip, upper=None, timeout=probe_timeout, mark=None):
+    """
+    Find the largest path MTU to `ip` among `candidates`, by sending a
+    ping of each size with fragmentation prohibited. All probes are sent
+    at once, so this normally takes one round trip, and at most `timeout`
+    seconds (if packets above some size are silently dropped).
+
+    Parameters
+    ----------
+    ip: IP address of the destination
+    upper: Don't probe sizes above this (e.g. the MTU of the local interface)
+    timeout: Treat probes that haven't been answered after this long as lost
+    mark: Firewall mark to send the probes with (the mark WireGuard puts
+          on its own packets, so they don't go through a tunnel)
+
+    Returns
+    -------
+    path_mtu: Largest size that got through, or `None` if none did (e.g.
+              because the server doesn't answer pings, or `ping` isn't
+              installed)
+    """
+    options = [] if mark is None else ping_options(ip, mark)
+    sizes = [size for size in candidates if upper is None or size <= upper]
+    if upper is not None and upper < candidates[0] and upper not in sizes:
+        sizes.insert(0, upper)
+    probes = []
+    try:
+        for size in sizes:
+            # the ping payload excludes the IPv4 (20) and ICMP (8) headers
+            probes.append((size, subprocess.Popen(
+                ["ping", "-n", "-q", "-c", "1", "-M", "do", "-W", str(max(int(timeout), 1)),
+                 *options, "-s", str(size - 28), ip],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )))
+    except FileNotFoundError:
+        return None
+    deadline = time.monotonic() + timeout
+    try:
+        # larger probes are checked first, so the first one that got
+        # through is the answer
+        for size, probe in probes:
+            try:
+                returncode = probe.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                continue
+            if returncode == 0:
+                return size
+        return None
+    finally:
+        for size, probe in probes:
+            if probe.poll() is None:
+                probe.kill()
+                probe.wait()
+
+def discover(ip, mark=None, timeout=probe_timeout):
+    """
+    Choose the MTU of a WireGuard tunnel to the endpoint `ip`: the path MTU
+    found by probing, less WireGuard's overhead, or if probing fails, the
+    MTU of the route to the endpoint less the overhead wg-quick assumes.
+
+    Parameters
+    ----------
+    ip: IP address of the endpoint
+    mark: Firewall mark to look up the route and send the probes with
+    timeout: Treat probes that haven't been answered after this long as lost
+
+    Returns
+    -------
+    mtu: Dictionary to be recorded in the connection status
+     - key 'value': MTU of the tunnel interface
+     - key 'path_mtu': Path MTU to the endpoint it is based on
+     - key 'method': 'probe' or 'route'
+    """
+    upper = route_mtu(ip, mark)
+    path_mtu = probe_path_mtu(ip, upper, timeout, mark)
+    if path_mtu is not None:
+        return {'value': path_mtu - overhead, 'path_mtu': path_mtu, 'method': 'probe'}
+    # paths across the internet rarely carry more than 1500 bytes, even if
+    # the local link does (e.g. jumbo frames in a cloud network)
+    if upper is None or upper > candidates[0]:
+        upper = candidates[0]
+    return {'value': upper - fallback_overhead, 'path_mtu': upper, 'method': 'route'}
+
+def interface_mtu(interface):
+    """
+    Get the MTU of a network interface, or `None` if it doesn't exist.
+    """
+    try:
+        with open(f'/sys/class/net/{interface}/mtu') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def mismatch(status):
+    """
+    Check whether the MTU of a connected tunnel looks wrong: if its interface
+    doesn't have the MTU that was configured, or if the route to the server
+    can no longer carry packets of that size with WireGuard's overhead added
+    (e.g. after moving to a PPPoE uplink, or after the kernel learned a
+    smaller path MTU).
+
+    Returns
+    -------
+    reason: Description of the suspected mismatch, or `None` if there is none
+            (or the tunnel's MTU wasn't recorded)
+    """
+    if 'mtu' not in status:
+        return None
+    configured = status['mtu']['value']
+    live = interface_mtu(status.get('interface', 'pia'))
+    if live is not None and live != configured:
+        return f"interface MTU is {live}, but {configured} was configured"
+    mark = status.get('routing', {}).get('table')
+    path = route_mtu(status['server']['ip'], mark)
+    if path is not None and configured + overhead > path:
+        return (f"route to {status['server']['ip']} carries at most {path} bytes,"
+                f" but the tunnel needs {configured + overhead}")
+    return None
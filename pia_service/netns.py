@@ -0,0 +1,413 @@
+import json
+import os
+import secrets
+import subprocess
+import sys
+import sysconfig
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import toml
+package_dir = os.path.dirname(__file__)
+store_path = os.path.join(package_dir, 'netns.toml')
+
+from .server_info import get_index
+from .auth import get_token, get_credentials, load_cached_token, AuthFailure
+from .connect import configure, get_template, choose_authority, KeyAddFailure
+from .port_forward import forward_port, rebind
+from .privileged import Transaction, ApplyFailure
+from .telemetry import read_interface
+from .tunnels import restore_ownership
+from . import trace
+
+# Name of the WireGuard interface inside each namespace
+interface = 'pia'
+# Maximum number of namespaces configured (or renewed) concurrently
+max_workers = 8
+CLONE_NEWNET = 0x40000000
+
+renew_service = "/etc/systemd/system/pia-netns-renew.service"
+renew_timer = "/etc/systemd/system/pia-netns-renew.timer"
+
+def load_namespaces():
+    """
+    Load the status of every namespace provisioned with `netns-up`.
+
+    Returns
+    -------
+    namespaces: Dictionary mapping namespace names to connection statuses
+    """
+    try:
+        return toml.load(store_path)
+    except FileNotFoundError:
+        return {}
+
+def save_namespaces(namespaces):
+    """
+    Write the status of all provisioned namespaces, readable only by the owner.
+    """
+    old_umask = os.umask(0o177)
+    try:
+        with open(store_path, 'w') as f:
+            toml.dump(namespaces, f)
+    finally:
+        os.umask(old_umask)
+
+def namespace_exists(namespace):
+    return os.path.exists(f'/run/netns/{namespace}')
+
+def setns(fd):
+    """
+    Move the calling thread into the network namespace referred to by `fd`.
+    """
+    if hasattr(os, 'setns'):
+        os.setns(fd, CLONE_NEWNET)
+        return
+    # os.setns() is new in Python 3.12
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+@contextmanager
+def inside(namespace):
+    """
+    Run the enclosed block with the calling thread (only) inside a named
+    network namespace, so that connections it opens, and subprocesses it
+    starts, use the namespace's tunnel. Requires root privileges.
+    """
+    with open('/proc/thread-self/ns/net') as own, open(f'/run/netns/{namespace}') as target:
+        setns(target.fileno())
+        try:
+            yield
+        finally:
+            setns(own.fileno())
+
+def render_config(status):
+    """
+    Render the WireGuard configuration (in the format read by `wg setconf`)
+    of a namespace's tunnel from its status.
+    """
+    return get_template("netns.conf.jinja").render(
+        key=status['wireguard']['key'],
+        server_pubkey=status['wireguard']['server_pubkey'],
+        endpoint=f"{status['server']['ip']}:{status['server']['port']}",
+    )
+
+def add_provision_steps(transaction, namespace, status):
+    """
+    Add the steps that create a namespace's tunnel to a transaction.
+
+    The WireGuard interface is created in the host's namespace and then
+    moved into `namespace`, so that its encrypted traffic is sent through
+    the host's network while everything inside the namespace goes through
+    the tunnel.
+    """
+    # interface names must be unique until the interface has been moved
+    tmp_name = f"pians{secrets.token_hex(4)}"
+    conf_path = f"/run/pia-service/{namespace}.conf"
+    if status['netns_created']:
+        transaction.command("ip", "netns", "add", namespace)
+    transaction.command("ip", "link", "add", "dev", tmp_name, "type", "wireguard")
+    transaction.command("ip", "link", "set", "dev", tmp_name, "netns", namespace)
+    transaction.command("ip", "-n", namespace, "link", "set", "dev", tmp_name,
+                        "name", interface)
+    # the private key only needs to be on disk until the kernel has it
+    transaction.write(conf_path, render_config(status), mode=0o600)
+    transaction.command("ip", "netns", "exec", namespace, "wg", "setconf", interface, conf_path)
+    transaction.remove(conf_path)
+    transaction.command("ip", "-n", namespace, "address", "add",
+                        f"{status['wireguard']['ip']}/32", "dev", interface)
+    if status['connection']['disable_ipv6']:
+        transaction.command("ip", "netns", "exec", namespace,
+                            "sysctl", "-q", "-w", "net.ipv6.conf.all.disable_ipv6=1")
+    if 'mtu' in status:
+        transaction.command("ip", "-n", namespace, "link", "set", "dev", interface,
+                            "mtu", str(status['mtu']['value']))
+    transaction.command("ip", "-n", namespace, "link", "set", "dev", "lo", "up")
+    transaction.command("ip", "-n", namespace, "link", "set", "dev", interface, "up")
+    transaction.command("ip", "-n", namespace, "route", "add", "default", "dev", interface)
+    # `ip netns exec` bind-mounts this over /etc/resolv.conf
+    transaction.mkdir(f"/etc/netns/{namespace}")
+    resolv_conf = ''.join(
+        f"nameserver {server}\n" for server in status['connection']['dns_servers']
+    )
+    transaction.write(f"/etc/netns/{namespace}/resolv.conf", resolv_conf)
+
+def add_teardown_steps(transaction, namespace, status):
+    """
+    Add the steps that remove a namespace's tunnel (and the namespace, if
+    it was created by `netns-up`) to a transaction.
+    """
+    transaction.command("ip", "-n", namespace, "link", "delete", "dev", interface,
+                        check=False)
+    transaction.remove(f"/etc/netns/{namespace}/resolv.conf")
+    transaction.command("rmdir", "--ignore-fail-on-non-empty", f"/etc/netns/{namespace}",
+                        check=False)
+    if status.get('netns_created'):
+        transaction.command("ip", "netns", "delete", namespace, check=False)
+
+def has_tunnel(namespace):
+    return subprocess.run(
+        ["ip", "-n", namespace, "link", "show", interface], capture_output=True,
+    ).returncode == 0
+
+def render_renew_units():
+    pia_service = os.path.join(sysconfig.get_path("scripts"), "pia-service")
+    return {
+        renew_timer: get_template("pia-netns-renew.timer.jinja").render(),
+        renew_service: get_template("pia-netns-renew.service.jinja").render(
+            pia_service=pia_service
+        ),
+    }
+
+@trace.timed('netns_up')
+def netns_up(args):
+    """
+    Give each of the named network namespaces its own PIA tunnel, to a
+    server in the specified region. The namespaces are created if they
+    don't exist yet.
+
+    The whole batch is set up with one authentication token and one look
+    at the server list. Keys are registered with the servers concurrently,
+    and all namespaces are then configured in a single privileged
+    transaction.
+    """
+    forward = args.forward_port
+    if forward and os.geteuid() != 0 and not args.dry_run:
+        # requests for ports have to be made from inside the namespaces
+        print("Forwarding ports for network namespaces requires running as root.",
+              file=sys.stderr)
+        print("Exiting.", file=sys.stderr)
+        return
+    provisioned = load_namespaces()
+    namespaces = []
+    for namespace in dict.fromkeys(args.namespaces):
+        if namespace in provisioned:
+            print(f'Namespace "{namespace}" already has a tunnel, skipping.', file=sys.stderr)
+        else:
+            namespaces.append(namespace)
+    if not namespaces:
+        return
+
+    # a dry run doesn't talk to PIA, so needs no credentials or token
+    token = None
+    if not args.dry_run:
+        username = password = None
+        if load_cached_token() is None:
+            username, password = get_credentials()
+        try:
+            with trace.span('get_token'):
+                token = get_token(username, password)
+        except AuthFailure as exc:
+            print("PIA authentication failed. Received response:")
+            print(exc.response)
+            print("Exiting.")
+            return
+    with trace.span('get_index'):
+        index = get_index()
+    if args.region not in index['regions']:
+        print(f"Unknown region {args.region!r}.", file=sys.stderr)
+        print("Exiting.", file=sys.stderr)
+        return
+
+    statuses = {}
+    workers = min(len(namespaces), max_workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            namespace: executor.submit(
+                trace.traced('configure_netns', configure, netns=namespace),
+                token,
+                args.region,
+                disable_ipv6=not args.no_disable_ipv6,
+                fastest=args.fastest,
+                hedge=args.hedge,
+                mtu=args.mtu,
+                dry_run=args.dry_run,
+            )
+            for namespace in namespaces
+        }
+        for namespace, future in futures.items():
+            try:
+                config, status = future.result()
+            except KeyAddFailure as exc:
+                print(f"{namespace}: Failed to add key to server. Response was:",
+                      file=sys.stderr)
+                print(f"{exc.response}", file=sys.stderr)
+                continue
+            # the routing set up for tunnels on the host doesn't apply here
+            del status['routing']
+            status['netns'] = namespace
+            status['netns_created'] = not namespace_exists(namespace)
+            statuses[namespace] = status
+
+    transaction = Transaction()
+    transaction.mkdir("/run/pia-service")
+    for namespace, status in statuses.items():
+        print(f"{namespace}: {status['server']['region']} ({status['server']['cn']})")
+        add_provision_steps(transaction, namespace, status)
+    if forward and not os.path.exists(renew_timer):
+        for path, content in render_renew_units().items():
+            transaction.write(path, content)
+        transaction.systemctl("daemon-reload")
+        transaction.systemctl("start", os.path.basename(renew_timer))
+    try:
+        with trace.span('provision'):
+            transaction.apply(dry_run=args.dry_run)
+    except ApplyFailure as exc:
+        # keep track of the namespaces that were set up before the failure
+        print(f"Failed to provision all namespaces: {exc}", file=sys.stderr)
+    if args.dry_run:
+        return
+    statuses = {
+        namespace: status for namespace, status in statuses.items()
+        if has_tunnel(namespace)
+    }
+    now = time.time()
+    for status in statuses.values():
+        status['connection']['connected_at'] = now
+
+    if forward:
+        def forward_from(namespace, status):
+            if not status['server']['allows_port_forwarding']:
+                return status
+            with inside(namespace):
+                # each namespace gets a port of its own, so stored ports
+                # (which may already be in use elsewhere) aren't reused
+                return forward_port(status, choose_authority(status, token, reuse=False))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                namespace: executor.submit(
+                    trace.traced('forward_netns', forward_from, netns=namespace),
+                    namespace, status,
+                )
+                for namespace, status in statuses.items()
+            }
+            for namespace, future in futures.items():
+                try:
+                    statuses[namespace] = future.result()
+                except OSError as exc:
+                    print(f"{namespace}: Port forwarding failed: {exc}", file=sys.stderr)
+
+    namespaces = load_namespaces()
+    namespaces.update(statuses)
+    save_namespaces(namespaces)
+    restore_ownership()
+
+def netns_down(args):
+    """
+    Remove the PIA tunnels from the named network namespaces (or from all
+    of them), deleting namespaces that were created by `netns-up`.
+    """
+    provisioned = load_namespaces()
+    if args.all:
+        namespaces = list(provisioned)
+    else:
+        namespaces = []
+        for namespace in dict.fromkeys(args.namespaces):
+            if namespace in provisioned:
+                namespaces.append(namespace)
+            else:
+                print(f'Namespace "{namespace}" has no tunnel, skipping.', file=sys.stderr)
+    if not namespaces:
+        return
+
+    transaction = Transaction()
+    for namespace in namespaces:
+        add_teardown_steps(transaction, namespace, provisioned[namespace])
+    remaining = {
+        namespace: status for namespace, status in provisioned.items()
+        if namespace not in namespaces
+    }
+    if not any('port_forward' in status for status in remaining.values()):
+        transaction.systemctl("stop", os.path.basename(renew_timer), check=False)
+        transaction.remove(renew_timer)
+        transaction.remove(renew_service)
+        transaction.systemctl("daemon-reload")
+    try:
+        transaction.apply(dry_run=args.dry_run)
+    except ApplyFailure as exc:
+        print(f"Failed to remove tunnels: {exc}", file=sys.stderr)
+        return
+    if args.dry_run:
+        return
+    namespaces_now = load_namespaces()
+    for namespace in namespaces:
+        namespaces_now.pop(namespace, None)
+    save_namespaces(namespaces_now)
+    restore_ownership()
+
+def netns_status(args):
+    """
+    Show the tunnels of all provisioned network namespaces. When running
+    as root, the time since each tunnel's latest handshake is included.
+    """
+    namespaces = load_namespaces()
+    rows = {}
+    for namespace, status in namespaces.items():
+        row = {
+            'region': status['server']['region'],
+            'server': status['server']['cn'],
+            'ip': status['wireguard']['ip'],
+            'port': status.get('port_forward', {}).get('port'),
+            'port_expires_at': status.get('port_forward', {}).get('expires_at'),
+            'handshake_age': None,
+        }
+        if os.geteuid() == 0 and namespace_exists(namespace):
+            with inside(namespace):
+                sample = read_interface(interface)
+            if sample is not None and sample['latest_handshake']:
+                row['handshake_age'] = round(sample['time'] - sample['latest_handshake'], 1)
+        rows[namespace] = row
+    if args.json:
+        print(json.dumps(rows))
+        return
+    if not rows:
+        print("No network namespaces provisioned")
+    for namespace, row in rows.items():
+        line = f"{namespace}: {row['region']} ({row['server']}), address {row['ip']}"
+        if row['port'] is not None:
+            line += f", port {row['port']} (expires {row['port_expires_at'][:19]})"
+        if row['handshake_age'] is not None:
+            line += f", handshake {row['handshake_age']} s ago"
+        print(line)
+
+@trace.timed('netns_renew')
+def netns_renew(args):
+    """
+    Re-bind the forwarded ports of all provisioned network namespaces
+    (run every 15 minutes by pia-netns-renew.timer, as root).
+    """
+    namespaces = load_namespaces()
+    forwarding = {
+        namespace: status for namespace, status in namespaces.items()
+        if 'port_forward' in status
+    }
+    if not forwarding:
+        print("No forwarded ports to renew")
+        return
+    def renew(namespace, status):
+        with inside(namespace):
+            return rebind(status, save=False)
+    with ThreadPoolExecutor(max_workers=min(len(forwarding), max_workers)) as executor:
+        futures = {
+            namespace: executor.submit(
+                trace.traced('renew_netns', renew, netns=namespace), namespace, status,
+            )
+            for namespace, status in forwarding.items()
+        }
+        for namespace, future in futures.items():
+            try:
+                future.result()
+            except OSError as exc:
+                # e.g. the namespace has been deleted behind our back
+                print(f"{namespace}: Renewal failed: {exc}", file=sys.stderr)
+
+    # namespaces may have been added or removed in the meantime
+    namespaces = load_namespaces()
+    for namespace, status in forwarding.items():
+        if namespace in namespaces:
+            namespaces[namespace] = status
+    save_namespaces(namespaces)
+    restore_ownership()
@@ -1,16 +1,18 @@
 import requests
-import subprocess
-import toml
 import json
 import os
 import sys
-import sysconfig
 import time
 import base64
 from datetime import datetime
 
 from .auth import get_token
-from .transport import DNSBypassAdapter
+from .transport import get_session
+from .authority_store import store_authority, newest_authority, is_expired
+from .telemetry import read_interface
+from .probe import tcp_rtt
+from .tunnels import default_name, check_name, load_status, save_status
+from . import trace
 package_dir = os.path.dirname(__file__)
 
 class PortRequestTimeout(Exception):
@@ -18,7 +20,19 @@ class PortRequestTimeout(Exception):
         super().__init__(f"Request to {uri} timed out")
         self.uri = uri
 
-def request_port(server, token):
+def tunnel_source(status):
+    """
+    Local address to send port forwarding requests from, so that they go
+    through the tunnel: the tunnel's own address for tunnels other than the
+    default one, which only route traffic from that address (and from the
+    chosen sources and marks), or `None` for the default tunnel, which
+    routes everything.
+    """
+    if status.get('interface', default_name) == default_name:
+        return None
+    return status['wireguard']['ip']
+
+def request_port(server, token, source_ip=None):
     """
     Request a new port from the specified server.
 
@@ -26,6 +40,7 @@ def request_port(server, token):
     ----------
     server: Server from which to request a port
     token: A valid PIA authentication token
+    source_ip: Local address to send the request from (see `tunnel_source()`)
 
     Returns
     -------
@@ -33,13 +48,11 @@ def request_port(server, token):
     """
     cn = server['cn']
     ip = server['ip']
-    session = requests.Session()
-    session.mount(f'https://{cn}', DNSBypassAdapter(cn, ip))
+    session = get_session(cn, ip, source_ip=source_ip)
     try:
         response = session.get(
             f'https://{cn}:19999/getSignature',
             params={'token': token},
-            verify=os.path.join(package_dir, "ca.rsa.4096.crt"),
             timeout=5,
         )
     except requests.exceptions.Timeout:
@@ -49,7 +62,7 @@ def request_port(server, token):
     signature = response_json['signature']
     return payload, signature
 
-def bind_port(server, payload, signature):
+def bind_port(server, payload, signature, source_ip=None):
     """
     Bind a port for which we have already received a payload and signature.
     Requires an open connection to a server that allows port forwarding.
@@ -58,6 +71,7 @@ def bind_port(server, payload, signature):
     ----------
     server: Server on which to bind the port
     payload, signature: Payload and signature received from PIA
+    source_ip: Local address to send the request from (see `tunnel_source()`)
 
     Returns
     -------
@@ -65,20 +79,28 @@ def bind_port(server, payload, signature):
     """
     cn = server['cn']
     ip = server['ip']
-    session = requests.Session()
-    session.mount(f'https://{cn}', DNSBypassAdapter(cn, ip))
+    session = get_session(cn, ip, source_ip=source_ip)
     try:
         response = session.get(
             f'https://{cn}:19999/bindPort',
             params={'payload': payload, 'signature': signature},
-            verify=os.path.join(package_dir, "ca.rsa.4096.crt"),
             timeout=5,
         )
     except requests.exceptions.Timeout:
         print(f"Request to https://{cn}:19999/bindPort timed out", file=sys.stderr)
         print("Abandoning attempt to bind port.", file=sys.stderr)
         return False
-    response_json = response.json()
+    except requests.exceptions.RequestException as exc:
+        print(f"Request to https://{cn}:19999/bindPort failed: {exc}", file=sys.stderr)
+        print("Abandoning attempt to bind port.", file=sys.stderr)
+        return False
+    try:
+        response_json = response.json()
+    except ValueError:
+        print(f"Failed to bind port (HTTP {response.status_code}). Response was:",
+              file=sys.stderr)
+        print(response.text.strip(), file=sys.stderr)
+        return False
     if 'status' not in response_json or response_json['status'] != 'OK':
         print("Failed to bind port. Response was:", file=sys.stderr)
         print(f"{response_json}", file=sys.stderr)
@@ -92,7 +114,45 @@ def bind_port(server, payload, signature):
             print(f"Server responds: {response_json['message']}")
         return True
 
-def forward_port(status, authority, wait=5):
+def wait_until_ready(server, deadline=10, interface='pia', source_ip=None):
+    """
+    Wait until the tunnel can carry port forwarding requests: that is, until
+    the WireGuard interface has completed a handshake with the server (if we
+    are able to check that) and the port forwarding API accepts connections.
+    Checks are retried with exponential backoff, up to a deadline.
+
+    Parameters
+    ----------
+    server: Server we are connected to
+     - key 'ip': Server IP address
+    deadline: Give up after this many seconds
+    interface: Name of the WireGuard interface
+    source_ip: Local address to connect from (see `tunnel_source()`)
+
+    Returns
+    -------
+    ready: Whether the tunnel became ready before the deadline
+    """
+    start = time.monotonic()
+    delay = 0.1
+    while True:
+        sample = read_interface(interface)
+        # latest_handshake is None if we can't tell, and 0 if none happened yet
+        handshake_done = sample is not None and sample['latest_handshake'] != 0
+        if handshake_done:
+            remaining = deadline - (time.monotonic() - start)
+            timeout = min(1.0, max(remaining, 0.1))
+            if tcp_rtt(server['ip'], 19999, timeout=timeout,
+                       source_ip=source_ip) is not None:
+                return True
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1.0)
+
+@trace.timed('forward_port')
+def forward_port(status, authority, wait=10):
     """
     Request that the server forward a port to the local host.
     Requires an open connection to a server that allows port forwarding.
@@ -107,7 +167,8 @@ def forward_port(status, authority, wait=5):
      * Alternative 2: Use a previously received port
        - key 'payload': Payload containing port number and expiration date
        - key 'signature': Signature previously provided by PIA
-    wait: Wait this many seconds before requesting the port
+    wait: Wait up to this many seconds for the tunnel to become ready
+          before requesting the port (0 to request it immediately)
     """
     server = status['server']
     # Check that we are connected to a server that allows port forwarding
@@ -117,18 +178,25 @@ def forward_port(status, authority, wait=5):
         print("Ignoring port forwarding request.", file=sys.stderr)
         return status
 
+    source_ip = tunnel_source(status)
     if wait:
-        print("Requesting forwarded port in ", end="", flush=True)
-        for i in range(wait, 0, -1):
-            print(f"{i}... ", end="", flush=True)
-            time.sleep(1)
-        print()
+        print("Waiting for tunnel... ", end="", flush=True)
+        start = time.monotonic()
+        interface = status.get('interface', default_name)
+        with trace.span('wait_ready') as fields:
+            fields['ready'] = wait_until_ready(server, deadline=wait, interface=interface,
+                                               source_ip=source_ip)
+        if fields['ready']:
+            print(f"ready after {time.monotonic() - start:.1f} s")
+        else:
+            print(f"not ready after {wait} s, trying anyway")
 
     if 'token' in authority:
         new_port = True
         token = authority['token']
         try:
-            payload, signature = request_port(server, token)
+            with trace.span('get_signature', server=server['cn']):
+                payload, signature = request_port(server, token, source_ip)
         except PortRequestTimeout as exc:
             print(f"Request to {exc.uri} timed out", file=sys.stderr)
             print("Abandoning port forwarding request.", file=sys.stderr)
@@ -150,45 +218,90 @@ def forward_port(status, authority, wait=5):
         'expires_at': expires_at,
         'payload': payload,
         'signature': signature,
+        # ports can only be bound on the server that issued them
+        'cn': server['cn'],
         'last_renewed': datetime.strftime(datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%fZ")
     }
     status['port_forward'] = authority
 
     if new_port:
-        old_umask = os.umask(0o177)
-        with open(os.path.join(package_dir, "port_authority.toml"), "a+") as f:
-            f.read() # now we're at the end of the file
-            toml.dump({'authority': [authority]}, f)
-        os.umask(old_umask)
+        with trace.span('store_authority'):
+            store_authority(authority, server)
 
-    bind_port(server, payload, signature)
+    with trace.span('bind_port', server=server['cn']) as fields:
+        fields['ok'] = bind_port(server, payload, signature, source_ip)
     return status
 
+@trace.timed('rebind')
+def rebind(status, save=True):
+    """
+    Re-bind the port recorded in `status`, and record the outcome (the
+    renewal time, or a failure) in `status` and in the tunnel's status file.
+
+    Parameters
+    ----------
+    status: Dictionary describing the connection status
+     - key 'server': Server we are currently connected to
+     - key 'port_forward': Details of the forwarded port
+    save: Whether to write the status file (callers keeping the status
+          elsewhere, e.g. `netns`, save it themselves)
+
+    Returns
+    -------
+    success: Whether binding the port was successful
+    """
+    server = status['server']
+    port_forward = status['port_forward']
+    # ports recorded before the issuing server was noted down are assumed
+    # to come from the current server
+    issued_by = port_forward.get('cn', server['cn'])
+    if is_expired(port_forward) or issued_by != server['cn']:
+        # e.g. the connection was moved to another server while refreshing
+        # it at boot, or the machine was off for longer than the port lasts
+        print(f"Port {port_forward['port']} has expired or was issued by"
+              f" another server, getting a new one")
+        authority = newest_authority(server['cn'])
+        if authority is None:
+            authority = {'token': get_token()}
+        forward_port(status, authority, wait=0)
+        if status['port_forward'] is not port_forward:
+            # keep the renewal counts of the port being replaced
+            for key in ('renewals', 'renewal_failures'):
+                if key in port_forward:
+                    status['port_forward'][key] = port_forward[key]
+        # binding it once more below also tells us whether that worked
+        port_forward = status['port_forward']
+    payload = port_forward['payload']
+    signature = port_forward['signature']
+
+    print(f"Attempting to re-bind to port {port_forward['port']}")
+
+    with trace.span('bind_port', server=server['cn']) as fields:
+        fields['ok'] = bind_port(server, payload, signature, tunnel_source(status))
+    if fields['ok']:
+        now = datetime.strftime(datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%fZ")
+        port_forward['last_renewed'] = now
+        port_forward['renewals'] = port_forward.get('renewals', 0) + 1
+    else:
+        port_forward['renewal_failures'] = port_forward.get('renewal_failures', 0) + 1
+    if save:
+        with trace.span('save_status'):
+            save_status(status, status.get('interface', default_name))
+    return fields['ok']
+
+@trace.timed('renew_port')
 def renew_port(args):
     """
     Re-bind a port that is currently being forwarded, so that the server
     doesn't forget the mapping. Should be called every 15 minutes to keep
     a port open indefinitely.
     """
-    try:
-        with open(os.path.join(package_dir, 'status.toml'), 'r') as f:
-            status = toml.load(f)
-    except FileNotFoundError:
+    with trace.span('load_status'):
+        status = load_status(check_name(args.name))
+    if status is None:
         print("Not connected", file=sys.stderr)
         return
     if 'port_forward' not in status:
         print("Port forwarding not active", file=sys.stderr)
         return
-    server = status['server']
-    payload = status['port_forward']['payload']
-    signature = status['port_forward']['signature']
-
-    print(f"Attempting to re-bind to port {status['port_forward']['port']}")
-
-    if bind_port(server, payload, signature):
-        now = datetime.strftime(datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%fZ")
-        status['port_forward']['last_renewed'] = now
-        old_umask = os.umask(0o177)
-        with open(os.path.join(package_dir, 'status.toml'), 'w') as f:
-            toml.dump(status, f)
-        os.umask(old_umask)
+    rebind(status)
@@ -0,0 +1,169 @@
+import base64
+import os
+import shlex
+import subprocess
+import sys
+import time
+from . import trace
+
+# Prefix of the lines a traced transaction script prints to mark progress
+step_marker = 'pia-service-step'
+
+class ApplyFailure(Exception):
+    def __init__(self, returncode):
+        super().__init__(f"Privileged operations failed with exit status {returncode}")
+        self.returncode = returncode
+
+def root_shell():
+    """
+    Command that runs a shell script read from stdin as root.
+    """
+    if os.geteuid() == 0:
+        return ["sh", "-s"]
+    return ["sudo", "sh", "-s"]
+
+def quote_command(command):
+    return ' '.join(shlex.quote(arg) for arg in command)
+
+class Transaction:
+    """
+    A batch of file and systemd operations that need root privileges.
+
+    Operations are collected first and then carried out, in the order they
+    were added, by a single shell script run with `sudo`. This way setting
+    up or tearing down a connection costs one sudo invocation rather than
+    one per file or unit. Files are written to a temporary path and then
+    renamed, so they are replaced atomically, and the script stops at the
+    first step that fails. When already running as root (e.g. in a
+    systemd unit), the script is run directly, without `sudo`.
+    """
+    def __init__(self):
+        # list of (description, shell code) pairs
+        self.steps = []
+
+    def __bool__(self):
+        return bool(self.steps)
+
+    def mkdir(self, path):
+        """
+        Create a directory (and its parents) if it doesn't already exist.
+        """
+        command = quote_command(["mkdir", "-p", path])
+        self.steps.append((command, command))
+
+    def write(self, path, content, mode=0o644):
+        """
+        Atomically replace the file at `path` with `content` (a string).
+        """
+        encoded = base64.b64encode(content.encode('utf-8')).decode('ascii')
+        tmp_path = shlex.quote(f"{path}.pia-service.tmp")
+        code = '\n'.join([
+            f"(umask 077; printf '%s' '{encoded}' | base64 -d > {tmp_path})",
+            f"chmod {mode:o} {tmp_path}",
+            f"mv -f {tmp_path} {shlex.quote(path)}",
+        ])
+        description = f"write {path} (mode {mode:o}, {len(content.encode('utf-8'))} bytes)"
+        self.steps.append((description, code))
+
+    def remove(self, path):
+        """
+        Remove a file, if it exists.
+        """
+        command = quote_command(["rm", "-f", path])
+        self.steps.append((command, command))
+
+    def systemctl(self, *args, check=True):
+        """
+        Run `systemctl` with the given arguments. If `check` is `False`,
+        a failure doesn't stop the rest of the transaction (e.g. when
+        stopping a unit that may not be running).
+        """
+        command = quote_command(["systemctl", *args])
+        self.steps.append((command, command if check else f"{command} || true"))
+
+    def command(self, *args, check=True):
+        """
+        Run an arbitrary command. If `check` is `False`, a failure doesn't
+        stop the rest of the transaction.
+        """
+        command = quote_command(args)
+        self.steps.append((command, command if check else f"{command} || true"))
+
+    def describe(self):
+        """
+        Describe the operations in this transaction, one per line.
+        """
+        return '\n'.join(description for description, code in self.steps)
+
+    def script(self, markers=False):
+        """
+        Render this transaction as a shell script.
+
+        Parameters
+        ----------
+        markers: If `True`, print a line with a timestamp when the script
+                 starts and after each step, so the steps can be timed.
+        """
+        lines = ["set -e"]
+        if markers:
+            lines.append(f'echo "{step_marker} start $(date +%s.%N)"')
+        for i, (description, code) in enumerate(self.steps):
+            lines.append(code)
+            if markers:
+                lines.append(f'echo "{step_marker} {i} $(date +%s.%N)"')
+        return '\n'.join(lines) + '\n'
+
+    def apply(self, dry_run=False):
+        """
+        Carry out all operations in a single `sudo` invocation.
+
+        Parameters
+        ----------
+        dry_run: If `True`, print the planned operations instead.
+        """
+        if dry_run:
+            print("Would run as root:")
+            for line in self.describe().split('\n'):
+                print(f"  {line}")
+            return
+        if not self:
+            return
+        if trace.enabled():
+            return self.apply_traced()
+        # the script goes on stdin, so that file contents (e.g. private keys)
+        # don't show up in the process list
+        result = subprocess.run(
+            root_shell(),
+            input=self.script().encode('utf-8'),
+        )
+        if result.returncode != 0:
+            raise ApplyFailure(result.returncode)
+
+    def apply_traced(self):
+        """
+        Like `apply()`, but record how long `sudo` took to start the script
+        (including any password prompt) and how long each step took.
+        """
+        started = time.time()
+        result = subprocess.run(
+            root_shell(),
+            input=self.script(markers=True).encode('utf-8'),
+            stdout=subprocess.PIPE,
+        )
+        previous = started
+        for line in result.stdout.decode('utf-8').splitlines():
+            fields = line.split()
+            if len(fields) != 3 or fields[0] != step_marker:
+                print(line)
+                continue
+            timestamp = float(fields[2])
+            if fields[1] == 'start':
+                trace.record('sudo', previous, timestamp - previous)
+            else:
+                description = self.steps[int(fields[1])][0]
+                trace.record('privileged_step', previous, timestamp - previous,
+                             step=description)
+            previous = timestamp
+        sys.stdout.flush()
+        if result.returncode != 0:
+            raise ApplyFailure(result.returncode)
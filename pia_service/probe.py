@@ -0,0 +1,138 @@
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+def bypass_socket_options(ip, mark):
+    """
+    Socket options that send connections to `ip` outside a tunnel, the way
+    WireGuard's own packets go: by setting the tunnel's firewall mark, or,
+    where that isn't permitted (it needs CAP_NET_ADMIN), by binding to the
+    interface that marked packets to `ip` are routed through (which
+    unprivileged processes may do since Linux 5.7). This is what lets the
+    servers be reached while the tunnel itself is broken.
+
+    Parameters
+    ----------
+    ip: IP address of a server to be reached
+    mark: Firewall mark of the tunnel (its routing table number)
+
+    Returns
+    -------
+    options: List of (level, option, value) tuples for `setsockopt()`
+             (empty if neither can be done)
+    """
+    options = [(socket.SOL_SOCKET, socket.SO_MARK, mark)]
+    if usable_socket_options(options):
+        return options
+    try:
+        result = subprocess.run(["ip", "-o", "route", "get", ip, "mark", str(mark)],
+                                capture_output=True)
+    except FileNotFoundError:
+        return []
+    fields = result.stdout.decode('utf-8').split()
+    if result.returncode != 0 or 'dev' not in fields:
+        return []
+    device = fields[fields.index('dev') + 1]
+    options = [(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, device.encode('utf-8'))]
+    if usable_socket_options(options):
+        return options
+    return []
+
+def usable_socket_options(options):
+    """
+    Check whether we are allowed to set the socket options `options`.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            for option in options:
+                sock.setsockopt(*option)
+        except OSError:
+            return False
+    return True
+
+def tcp_rtt(ip, port=1337, timeout=1.0, socket_options=(), source_ip=None):
+    """
+    Measure the time taken to open a TCP connection to a server.
+
+    Parameters
+    ----------
+    ip: IP address of the server
+    port: TCP port to connect to (by default, the WireGuard API port)
+    timeout: Give up after this many seconds
+    socket_options: Options to set on the socket before connecting (see
+                    `bypass_socket_options()`)
+    source_ip: Local address to connect from
+
+    Returns
+    -------
+    rtt: Connection time in seconds, or `None` if the connection failed
+    """
+    start = time.monotonic()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            for option in socket_options:
+                sock.setsockopt(*option)
+            if source_ip is not None:
+                sock.bind((source_ip, 0))
+            sock.settimeout(timeout)
+            sock.connect((ip, port))
+    except OSError:
+        return None
+    return time.monotonic() - start
+
+def probe_servers(servers, port=1337, timeout=1.0, deadline=2.0, max_workers=16,
+                  socket_options=()):
+    """
+    Measure the round-trip time to several servers concurrently.
+
+    Parameters
+    ----------
+    servers: List of dictionaries representing servers
+     - key 'cn': Server common name
+     - key 'ip': Server IP address
+    port: TCP port to connect to
+    timeout: Timeout for each individual connection, in seconds
+    deadline: Overall time limit for the probe, in seconds. Servers that
+              haven't responded by then are treated as unreachable.
+    max_workers: Maximum number of connections open at once
+    socket_options: Options to set on each socket (see `tcp_rtt()`)
+
+    Returns
+    -------
+    rtts: Dictionary mapping server common names to round-trip times in
+          seconds (`None` for servers that could not be reached)
+    """
+    rtts = {server['cn']: None for server in servers}
+    if not servers:
+        return rtts
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(servers)))
+    futures = {
+        executor.submit(tcp_rtt, server['ip'], port, timeout, socket_options): server['cn']
+        for server in servers
+    }
+    done, not_done = wait(futures, timeout=deadline)
+    for future in not_done:
+        future.cancel()
+    # don't wait for stragglers; they will give up after `timeout` anyway
+    executor.shutdown(wait=False)
+    for future in done:
+        rtts[futures[future]] = future.result()
+    return rtts
+
+def fastest_server(servers, **kwargs):
+    """
+    Probe a list of servers and choose the one with the lowest round-trip
+    time. Keyword arguments are passed on to `probe_servers()`.
+
+    Returns
+    -------
+    server: The fastest server, or `None` if none could be reached
+    rtts: Dictionary mapping server common names to round-trip times
+    """
+    rtts = probe_servers(servers, **kwargs)
+    reachable = [server for server in servers if rtts[server['cn']] is not None]
+    if not reachable:
+        return None, rtts
+    server = min(reachable, key=lambda server: rtts[server['cn']])
+    return server, rtts
@@ -1,23 +1,368 @@
-import requests
+import fcntl
+import toml
 import json
+import os
+import sys
+import time
+import random
+import statistics
+from .probe import probe_servers
+package_dir = os.path.dirname(__file__)
+
+serverlist_url = 'https://serverlist.piaservers.net/vpninfo/servers/v6'
+cache_path = os.path.join(package_dir, 'serverlist.json')
+cache_stats_path = os.path.join(package_dir, 'serverlist_stats.toml')
+# held while updating the counters, since the file is replaced rather
+# than rewritten in place
+cache_stats_lock_path = os.path.join(package_dir, 'serverlist_stats.lock')
+index_path = os.path.join(package_dir, 'serverlist_index.json')
+
+# Bump when the layout of the index changes, so old indexes are rebuilt
+index_version = 1
+# Region attributes that can be used to filter regions via the index
+capabilities = ['port_forward', 'geo', 'offline']
+
+# How long (in seconds) a cached copy of the server list is used without
+# checking back with the API. Can be overridden with PIA_SERVERLIST_TTL.
+default_ttl = 3600
+
+def get_ttl():
+    """
+    Get the server list cache TTL in seconds, taking the environment
+    variable PIA_SERVERLIST_TTL into account if it is set.
+    """
+    try:
+        return float(os.environ['PIA_SERVERLIST_TTL'])
+    except (KeyError, ValueError):
+        return default_ttl
+
+def load_cache():
+    """
+    Load the cached copy of the server list, if there is one.
+
+    Returns
+    -------
+    cache: Dictionary representing the cached server list, or `None`
+     - key 'fetched_at': Time (in seconds since the epoch) of last validation
+     - key 'etag': ETag header sent with the cached copy (may be `None`)
+     - key 'last_modified': Last-Modified header sent with the cached copy
+     - key 'info': Parsed server list
+    """
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_cache(cache):
+    """
+    Atomically replace the cached copy of the server list.
+    """
+    tmp_path = f'{cache_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        # json.dumps() uses the C encoder, which json.dump() doesn't
+        f.write(json.dumps(cache))
+    os.replace(tmp_path, cache_path)
+
+def record_cache_event(event):
+    """
+    Increment one of the server list cache counters kept in
+    `serverlist_stats.toml`. Events are 'hit' (fresh cached copy used),
+    'revalidated' (server confirmed the cached copy is current), 'miss'
+    (full download) and 'stale' (API unreachable, stale copy used).
+    The counters are updated under a lock, so that concurrent threads and
+    processes don't lose counts, and never raise into the caller.
+    """
+    try:
+        with open(cache_stats_lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stats = toml.load(cache_stats_path)
+            except FileNotFoundError:
+                stats = {}
+            stats[event] = stats.get(event, 0) + 1
+            tmp_path = f"{cache_stats_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                toml.dump(stats, f)
+            os.replace(tmp_path, cache_stats_path)
+    except (OSError, ValueError):
+        # statistics are best-effort, e.g. if the package dir is read-only
+        # or the file was damaged (toml's decode error is a ValueError)
+        pass
+
+def fetch_serverlist(max_age=None):
+    """
+    Get the PIA server list, using the on-disk cache where possible.
+    See `update_cache()`.
+
+    Returns
+    -------
+    info: Dictionary representing the parsed server list
+    """
+    return update_cache(max_age)['info']
+
+def update_cache(max_age=None):
+    """
+    Make sure the on-disk copy of the PIA server list is up to date.
+
+    A cached copy younger than `max_age` seconds is used as-is. An older
+    copy is revalidated with the API using its ETag and Last-Modified
+    headers, and only downloaded again if it has changed. If the API can't
+    be reached, a stale cached copy is used instead.
+
+    Parameters
+    ----------
+    max_age: Maximum age (in seconds) of a cached copy to use without
+             revalidation. If `None`, use the configured TTL.
+
+    Returns
+    -------
+    cache: Dictionary representing the cached server list (see `load_cache()`)
+    """
+    if max_age is None:
+        max_age = get_ttl()
+    cache = load_cache()
+    if cache is not None and time.time() - cache['fetched_at'] < max_age:
+        record_cache_event('hit')
+        return cache
+
+    # only import requests when we actually need to talk to the API, since
+    # it accounts for a large part of the startup time
+    import requests
+    headers = {}
+    if cache is not None:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+    try:
+        response = requests.get(serverlist_url, headers=headers, timeout=10)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as exc:
+        if cache is None:
+            raise
+        print(f"Could not update server list ({exc})", file=sys.stderr)
+        print("Using cached copy.", file=sys.stderr)
+        record_cache_event('stale')
+        return cache
+
+    if response.status_code == 304:
+        record_cache_event('revalidated')
+        cache['fetched_at'] = time.time()
+    else:
+        record_cache_event('miss')
+        # The server list is followed by a signature on a separate line
+        info = json.loads(response.content.decode('utf-8').split('\n')[0])
+        cache = {
+            'fetched_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'info': info,
+        }
+    try:
+        save_cache(cache)
+    except OSError as exc:
+        print(f"Could not write server list cache ({exc})", file=sys.stderr)
+    return cache
+
+def build_index(info, fetched_at):
+    """
+    Build a compact index of the server list, holding only what lookups
+    need: the attributes of each region and its WireGuard servers (the
+    other server groups make up most of the full list), plus tables for
+    looking up servers by common name and regions by capability.
+
+    Returns
+    -------
+    index: Dictionary representing the index
+     - key 'fetched_at': Time the server list was last validated
+     - key 'regions': Dictionary mapping region ids to regions, in the
+       order of the server list. Regions have the same layout as in the
+       full list, except that 'servers' only has the key 'wg'.
+     - key 'servers': Dictionary mapping server common names to the ids
+       of their regions
+     - key 'capabilities': Dictionary mapping each of `capabilities` to
+       the ids of the regions that have it
+    """
+    index = {
+        'version': index_version,
+        'fetched_at': fetched_at,
+        'regions': {},
+        'servers': {},
+        'capabilities': {capability: [] for capability in capabilities},
+    }
+    for region in info['regions']:
+        wg_servers = [
+            {'cn': server['cn'], 'ip': server['ip']}
+            for server in region['servers'].get('wg', [])
+        ]
+        index['regions'][region['id']] = {
+            'id': region['id'],
+            'name': region['name'],
+            'country': region['country'],
+            'geo': region['geo'],
+            'offline': region['offline'],
+            'port_forward': region['port_forward'],
+            'servers': {'wg': wg_servers},
+        }
+        for server in wg_servers:
+            index['servers'][server['cn']] = region['id']
+        for capability in capabilities:
+            if region[capability]:
+                index['capabilities'][capability].append(region['id'])
+    return index
+
+def load_index():
+    """
+    Load the server list index, or `None` if there is no usable index.
+    """
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if index.get('version') != index_version:
+        return None
+    return index
+
+def save_index(index):
+    """
+    Atomically replace the server list index.
+    """
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(index, separators=(',', ':')))
+    os.replace(tmp_path, index_path)
+
+def get_index(max_age=None):
+    """
+    Get the index of the PIA server list (see `build_index()`).
+
+    While the index is younger than `max_age` seconds (by default, the
+    configured TTL), it is used without reading the full server list.
+    Otherwise the server list cache is brought up to date first, and the
+    index rebuilt from it.
+    """
+    if max_age is None:
+        max_age = get_ttl()
+    index = load_index()
+    if index is not None and time.time() - index['fetched_at'] < max_age:
+        record_cache_event('hit')
+        return index
+    cache = update_cache(max_age)
+    index = build_index(cache['info'], cache['fetched_at'])
+    try:
+        save_index(index)
+    except OSError as exc:
+        print(f"Could not write server list index ({exc})", file=sys.stderr)
+    return index
 
 def get_regions(as_dict=True):
-    response = requests.get('https://serverlist.piaservers.net/vpninfo/servers/v6')
-    info = json.loads(response.content.decode('utf-8').split('\n')[0])
+    regions = get_index()['regions']
     if as_dict:
-        return {region['id']: region for region in info['regions']}
+        return regions
     else:
-        return info['regions']
+        return list(regions.values())
+
+def find_server(cn, index=None):
+    """
+    Look up a WireGuard server by its common name.
+
+    Returns
+    -------
+    region: Dictionary representing the server's region
+    server: Dictionary representing the server
+     - key 'cn': Server common name
+     - key 'ip': Server IP address
+    """
+    if index is None:
+        index = get_index()
+    region = index['regions'][index['servers'][cn]]
+    for server in region['servers']['wg']:
+        if server['cn'] == cn:
+            return region, server
+
+def filter_regions(index, **required):
+    """
+    Get the regions whose capabilities (see `capabilities`) have the given
+    values, e.g. `filter_regions(index, port_forward=True, geo=False)`,
+    in the order of the server list.
+    """
+    ids = set(index['regions'])
+    for capability, value in required.items():
+        having = set(index['capabilities'][capability])
+        ids = ids & having if value else ids - having
+    return [region for region_id, region in index['regions'].items() if region_id in ids]
+
+def rank_regions(regions, sample=2, deadline=5.0, max_workers=32):
+    """
+    Rank regions by latency, by probing a random sample of WireGuard servers
+    from each region concurrently.
+
+    Parameters
+    ----------
+    regions: List of dictionaries representing PIA regions
+    sample: Number of servers to probe in each region
+    deadline: Overall time limit for the probe, in seconds
+    max_workers: Maximum number of connections open at once
+
+    Returns
+    -------
+    ranked: List of (region, rtt) pairs, where `rtt` is the median round-trip
+            time in seconds to the responding servers in the region (or
+            `None` if none responded), sorted with the fastest first
+    """
+    servers = []
+    region_cns = {}
+    for region in regions:
+        wg_servers = region['servers'].get('wg', [])
+        chosen = random.sample(wg_servers, min(sample, len(wg_servers)))
+        servers.extend(chosen)
+        region_cns[region['id']] = [server['cn'] for server in chosen]
+    rtts = probe_servers(servers, deadline=deadline, max_workers=max_workers)
+
+    ranked = []
+    for region in regions:
+        region_rtts = [rtts[cn] for cn in region_cns[region['id']] if rtts[cn] is not None]
+        median = statistics.median(region_rtts) if region_rtts else None
+        ranked.append((region, median))
+    ranked.sort(key=lambda item: (item[1] is None, item[1] or 0, item[0]['name']))
+    return ranked
 
 def list_regions(args):
-    regions = get_regions(as_dict=False)
+    required = {}
     if args.no_geo:
-        regions = [region for region in regions if not region['geo']]
+        required['geo'] = False
     if args.port_forward:
-        regions = [region for region in regions if region['port_forward']]
+        required['port_forward'] = True
+    regions = filter_regions(get_index(), **required)
+    if args.sort == 'latency':
+        ranked = rank_regions(regions)
+    else:
+        ranked = [
+            (region, None)
+            for region in sorted(regions, key=lambda region: region['name'])
+        ]
+    if args.top is not None:
+        ranked = ranked[:args.top]
+
+    if args.json:
+        output = []
+        for region, rtt in ranked:
+            entry = {'id': region['id'], 'name': region['name']}
+            if args.sort == 'latency':
+                entry['rtt_ms'] = None if rtt is None else round(rtt*1000, 1)
+            output.append(entry)
+        print(json.dumps(output))
+        return
     print('Available regions:')
-    for region in sorted(regions, key=lambda region: region['name']):
-        print(f" - {region['name']} ({region['id']})")
+    for region, rtt in ranked:
+        if args.sort != 'latency':
+            print(f" - {region['name']} ({region['id']})")
+        elif rtt is None:
+            print(f" - {region['name']} ({region['id']}): unreachable")
+        else:
+            print(f" - {region['name']} ({region['id']}): {rtt*1000:.1f} ms")
 
 def region_info(args):
     regions = get_regions()
@@ -32,3 +377,24 @@ def region_info(args):
     for server in servers['wg']:
         print(f" - {server['cn']} @ {server['ip']}")
 
+def cache_info(args):
+    """
+    Print the state of the server list cache and its hit/miss counters.
+    """
+    cache = load_cache()
+    if cache is None:
+        print("Server list not cached")
+    else:
+        age = time.time() - cache['fetched_at']
+        print(f"Server list cached at {cache_path}")
+        print(f"Last validated {age:.0f} s ago (TTL {get_ttl():.0f} s)")
+    index = load_index()
+    if index is not None:
+        print(f"Index at {index_path} ({len(index['regions'])} regions,"
+              f" {len(index['servers'])} WireGuard servers)")
+    try:
+        stats = toml.load(cache_stats_path)
+    except (FileNotFoundError, ValueError):
+        stats = {}
+    for event in ['hit', 'revalidated', 'miss', 'stale']:
+        print(f"{event.capitalize()}: {stats.get(event, 0)}")
@@ -1,31 +1,145 @@
-import toml
 import os
+import json
+import socket
+import time
+from .tunnels import default_name, check_name, load_status, connected_tunnels
+from .mtu import mismatch
 package_dir = os.path.dirname(__file__)
 
-def get_status(args):
+def socket_path(name=default_name):
+    """
+    Path of the Unix socket on which the renewal daemon for a tunnel
+    answers status queries.
+    """
+    if name == default_name:
+        return os.path.join(package_dir, 'daemon.sock')
+    return os.path.join(package_dir, f'daemon-{name}.sock')
+
+def query_daemon(name=default_name, timeout=1.0):
+    """
+    Ask a running renewal daemon (see `daemon.py`) for its state.
+
+    Returns
+    -------
+    state: Dictionary with keys 'status' (the connection status) and
+           'daemon' (renewal statistics), or `None` if no daemon is running.
+    """
     try:
-        with open(os.path.join(package_dir, 'status.toml'), 'r') as f:
-            status = toml.load(f)
-    except FileNotFoundError:
-        print("Not connected")
-        return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path(name))
+            sock.sendall(b'status\n')
+            response = b''
+            while not response.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+    except OSError:
+        return None
+    try:
+        return json.loads(response.decode('utf-8'))
+    except ValueError:
+        return None
+
+def watch_status(args):
+    """
+    Print a snapshot of the live state of a tunnel (or of every connected
+    tunnel, unless one is named), either once or (with `--watch`)
+    repeatedly, as JSON or as a single human-readable line per tunnel.
+    """
+    from .telemetry import read_interface, snapshot, format_snapshot
+    previous = {}
+    while True:
+        if args.name is not None:
+            names = [check_name(args.name)]
+        else:
+            # tunnels may come and go while watching
+            names = connected_tunnels() or [default_name]
+        for name in names:
+            sample = read_interface(name)
+            current = snapshot(load_status(name), sample, previous.get(name), name)
+            if args.json:
+                print(json.dumps(current, separators=(',', ':')), flush=True)
+            elif len(names) > 1:
+                print(f"[{name}] {format_snapshot(current)}", flush=True)
+            else:
+                print(format_snapshot(current), flush=True)
+            previous[name] = sample
+        if args.watch is None:
+            return
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            return
+
+def print_status(status, name, verbose=False):
     connection = status['connection']
     server = status['server']
     wireguard = status['wireguard']
     print(f"Connected to {server['region']} ({server['cn']}) via WireGuard")
     print(f"Public IP address: {connection['pub_ip']}")
-    if args.verbose:
+    if verbose:
         print(f"WireGuard IP address: {wireguard['ip']}")
         print(f"Server WireGuard IP: {wireguard['server_ip']}")
         print(f"Using DNS servers: {', '.join(connection['dns_servers'])}")
         print(f"Server endpoint: {server['ip']}:{server['port']}")
+        if 'latency' in status and server['cn'] in status['latency']:
+            print(f"Server latency at connect time: {status['latency'][server['cn']]} ms")
+        if 'mtu' in status:
+            mtu = status['mtu']
+            if mtu['method'] == 'probe':
+                print(f"MTU: {mtu['value']} (path MTU to server {mtu['path_mtu']})")
+            elif mtu['method'] == 'route':
+                print(f"MTU: {mtu['value']} (path MTU not probed, route MTU {mtu['path_mtu']})")
+            else:
+                print(f"MTU: {mtu['value']}")
+    if name != default_name:
+        routing = status['routing']
+        print(f"Routing table: {routing['table']}")
+        for source in routing['sources']:
+            print(f"Routing traffic from {source}")
+        for mark in routing['marks']:
+            print(f"Routing traffic with firewall mark {mark}")
     if 'port_forward' in status:
         port_forward = status['port_forward']
         print(f"Forwarded port: {port_forward['port']}")
-        if args.verbose:
+        if verbose:
             print(f"Port expires at: {port_forward['expires_at']}")
             print(f"Port last renewed at: {port_forward['last_renewed']}")
+            state = query_daemon(name)
+            if state is not None:
+                daemon = state['daemon']
+                print(f"Renewal daemon running (pid {daemon['pid']}):"
+                      f" {daemon['renewals']} renewals, {daemon['failures']} failures")
+                if daemon['next_renewal'] is not None:
+                    remaining = daemon['next_renewal'] - time.time()
+                    print(f"Next renewal in {max(remaining, 0):.0f} s")
+    if verbose:
+        # looks up the route to the server, so keep it out of plain `status`
+        reason = mismatch(status)
+        if reason is not None:
+            print(f"Suspected MTU mismatch: {reason}")
     if connection['disable_ipv6']:
         print("IPv6 disabled")
     else:
         print("IPv6 not disabled")
+
+def get_status(args):
+    if args.json or args.watch is not None:
+        watch_status(args)
+        return
+    if args.name is not None:
+        names = [check_name(args.name)]
+    else:
+        names = connected_tunnels() or [default_name]
+    for i, name in enumerate(names):
+        status = load_status(name)
+        if len(names) > 1:
+            if i > 0:
+                print()
+            print(f"[{name}]")
+        if status is None:
+            print("Not connected")
+            continue
+        print_status(status, name, args.verbose)
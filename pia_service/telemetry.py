@@ -0,0 +1,172 @@
+import os
+import subprocess
+import time
+from datetime import datetime
+from .mtu import mismatch
+
+def wg_dump(interface='pia'):
+    """
+    Run `wg show <interface> dump`, using `sudo -n` when not running as root
+    (so that we fail instead of prompting for a password).
+
+    Returns
+    -------
+    lines: List of tab-separated fields for each line of output, or `None`
+           if the command failed
+    """
+    command = ["wg", "show", interface, "dump"]
+    if os.geteuid() != 0:
+        command = ["sudo", "-n"] + command
+    try:
+        result = subprocess.run(command, capture_output=True)
+    except FileNotFoundError:
+        return None
+    if result.returncode != 0:
+        return None
+    output = result.stdout.decode('utf-8').strip()
+    return [line.split('\t') for line in output.split('\n')]
+
+def read_sysfs_counters(interface='pia'):
+    """
+    Read the rx/tx byte counters of a network interface from sysfs, which
+    (unlike `wg show`) doesn't need root privileges.
+    """
+    counters = {}
+    for name in ['rx_bytes', 'tx_bytes']:
+        path = f'/sys/class/net/{interface}/statistics/{name}'
+        with open(path, 'r') as f:
+            counters[name] = int(f.read())
+    return counters
+
+def read_interface(interface='pia'):
+    """
+    Read the live counters of the WireGuard interface.
+
+    Returns
+    -------
+    sample: Dictionary describing the interface, or `None` if it doesn't exist
+     - key 'time': Time at which the counters were read (seconds since epoch)
+     - key 'latest_handshake': Time of the latest handshake with the peer
+       (seconds since epoch; 0 if there has been none, `None` if unknown)
+     - key 'rx_bytes', 'tx_bytes': Bytes received and sent
+     - key 'endpoint': Peer endpoint, if known
+    """
+    now = time.time()
+    dump = wg_dump(interface)
+    # the first line describes the interface itself, the rest describe peers
+    if dump is not None and len(dump) > 1 and len(dump[1]) >= 7:
+        peer = dump[1]
+        return {
+            'time': now,
+            'latest_handshake': int(peer[4]),
+            'rx_bytes': int(peer[5]),
+            'tx_bytes': int(peer[6]),
+            'endpoint': peer[2],
+        }
+    try:
+        counters = read_sysfs_counters(interface)
+    except FileNotFoundError:
+        return None
+    return {
+        'time': now,
+        'latest_handshake': None,
+        'rx_bytes': counters['rx_bytes'],
+        'tx_bytes': counters['tx_bytes'],
+        'endpoint': None,
+    }
+
+def wait_for_handshake(interface='pia', deadline=5.0):
+    """
+    Wait for a (newly created) WireGuard interface to complete a handshake
+    with its peer, polling with exponential backoff up to a deadline.
+
+    Returns
+    -------
+    handshake: `True` if there was a handshake, `False` if there was none
+               before the deadline, or `None` if handshakes can't be observed
+               (because `wg show` can't be run)
+    """
+    start = time.monotonic()
+    delay = 0.05
+    while True:
+        sample = read_interface(interface)
+        # the interface may not exist yet
+        if sample is not None:
+            if sample['latest_handshake'] is None:
+                return None
+            if sample['latest_handshake']:
+                return True
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
+
+def snapshot(status, sample, previous=None, interface='pia'):
+    """
+    Combine the connection status and a sample of the interface counters
+    into a compact snapshot, computing throughput relative to a previous
+    sample if one is given.
+
+    Parameters
+    ----------
+    status: Dictionary representing connection status (or `None`)
+    sample: Interface counters, as returned by `read_interface()` (or `None`)
+    previous: Earlier interface counters, for computing throughput
+    interface: Name of the tunnel's interface
+
+    Returns
+    -------
+    snapshot: Flat dictionary suitable for serializing as JSON
+    """
+    now = time.time() if sample is None else sample['time']
+    result = {'time': round(now, 3), 'interface': interface, 'up': sample is not None}
+    if status is not None:
+        result['region'] = status['server']['region']
+        result['server'] = status['server']['cn']
+        result['pub_ip'] = status['connection']['pub_ip']
+    if sample is not None:
+        result['rx_bytes'] = sample['rx_bytes']
+        result['tx_bytes'] = sample['tx_bytes']
+        handshake = sample['latest_handshake']
+        if handshake:
+            result['handshake_age'] = round(now - handshake, 1)
+        else:
+            result['handshake_age'] = None
+        if previous is not None and sample['time'] > previous['time']:
+            elapsed = sample['time'] - previous['time']
+            result['rx_rate'] = round((sample['rx_bytes'] - previous['rx_bytes']) / elapsed, 1)
+            result['tx_rate'] = round((sample['tx_bytes'] - previous['tx_bytes']) / elapsed, 1)
+    if status is not None and 'port_forward' in status:
+        port_forward = status['port_forward']
+        result['port'] = port_forward['port']
+        # truncate PIA's ns-precision timestamps to us, as elsewhere
+        expiration = datetime.strptime(
+            port_forward['expires_at'][:26], '%Y-%m-%dT%H:%M:%S.%f'
+        )
+        result['port_expires_in'] = round(
+            (expiration - datetime.utcnow()).total_seconds()
+        )
+    if status is not None and 'mtu' in status:
+        result['mtu'] = status['mtu']['value']
+        # only meaningful while the interface exists
+        result['mtu_mismatch'] = sample is not None and mismatch(status) is not None
+    return result
+
+def format_snapshot(snapshot):
+    """
+    Format a snapshot as a single human-readable line.
+    """
+    if not snapshot['up']:
+        return f"{snapshot['interface']} interface down"
+    parts = [f"rx {snapshot['rx_bytes']} B", f"tx {snapshot['tx_bytes']} B"]
+    if 'rx_rate' in snapshot:
+        parts.append(f"rx {snapshot['rx_rate']:.0f} B/s")
+        parts.append(f"tx {snapshot['tx_rate']:.0f} B/s")
+    if snapshot['handshake_age'] is not None:
+        parts.append(f"handshake {snapshot['handshake_age']:.0f} s ago")
+    if 'port_expires_in' in snapshot:
+        parts.append(f"port {snapshot['port']} expires in {snapshot['port_expires_in']} s")
+    if snapshot.get('mtu_mismatch'):
+        parts.append(f"suspected MTU mismatch (MTU {snapshot['mtu']})")
+    return ', '.join(parts)
@@ -0,0 +1,125 @@
+import functools
+import itertools
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+package_dir = os.path.dirname(__file__)
+default_trace_path = os.path.join(package_dir, 'trace.jsonl')
+
+# Identifies the spans recorded by one invocation of pia-service
+run_id = secrets.token_hex(6)
+span_ids = itertools.count(1)
+local = threading.local()
+lock = threading.Lock()
+
+def enabled():
+    """
+    Whether timing spans are being recorded. Tracing is switched on by
+    the `--trace` option, or by setting the environment variable PIA_TRACE
+    to a non-empty value other than 0.
+    """
+    return os.environ.get('PIA_TRACE', '0') not in ('', '0')
+
+def trace_path():
+    """
+    Path of the file spans are appended to: `trace.jsonl` in the package
+    directory, unless overridden with PIA_TRACE_FILE.
+    """
+    return os.environ.get('PIA_TRACE_FILE', default_trace_path)
+
+def current_span():
+    stack = getattr(local, 'stack', None)
+    return stack[-1] if stack else None
+
+def write_span(span_id, name, start, duration, parent, fields):
+    line = json.dumps({
+        'run': run_id,
+        'pid': os.getpid(),
+        'id': span_id,
+        'parent': parent,
+        'span': name,
+        'start': round(start, 6),
+        'duration': round(duration, 6),
+        **fields,
+    })
+    old_umask = os.umask(0o177)
+    try:
+        with lock, open(trace_path(), 'a') as f:
+            f.write(line + '\n')
+    except OSError:
+        # tracing is best-effort, and must never break a connection
+        pass
+    finally:
+        os.umask(old_umask)
+
+def record(name, start, duration, parent=None, **fields):
+    """
+    Record a span that was timed elsewhere (e.g. by a subprocess).
+
+    Parameters
+    ----------
+    name: Name of the phase
+    start: Start time (seconds since epoch)
+    duration: Duration in seconds
+    parent: Id of the enclosing span (default: the current span)
+    fields: Additional attributes to record
+    """
+    if parent is None:
+        parent = current_span()
+    write_span(next(span_ids), name, start, duration, parent, fields)
+
+@contextmanager
+def span(name, parent=None, **fields):
+    """
+    Time the enclosed block as a span called `name`. Yields a dictionary
+    to which further attributes can be added while the block runs. Spans
+    opened inside the block (in the same thread) record this one as their
+    parent. If the block raises an exception, its type is recorded under
+    'error'. Does nothing (beyond yielding) when tracing is disabled.
+    """
+    if not enabled():
+        yield fields
+        return
+    if parent is None:
+        parent = current_span()
+    stack = local.__dict__.setdefault('stack', [])
+    # reserve the id now, so that nested spans can refer to it
+    span_id = next(span_ids)
+    stack.append(span_id)
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as exc:
+        fields['error'] = type(exc).__name__
+        raise
+    finally:
+        stack.pop()
+        write_span(span_id, name, start, time.perf_counter() - started, parent, fields)
+
+def traced(name, func, **fields):
+    """
+    Wrap `func` so that each call is timed as a span called `name`. The
+    span's parent is the span that was current when `traced()` was called,
+    so this can be used for work submitted to another thread.
+    """
+    parent = current_span() if enabled() else None
+    def wrapper(*args, **kwargs):
+        with span(name, parent=parent, **fields):
+            return func(*args, **kwargs)
+    return wrapper
+
+def timed(name):
+    """
+    Decorator timing each call of a function as a span called `name`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
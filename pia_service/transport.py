@@ -1,5 +1,28 @@
+import os
 from requests import Session
 from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.ssl_ import create_urllib3_context
+package_dir = os.path.dirname(__file__)
+ca_path = os.path.join(package_dir, "ca.rsa.4096.crt")
+
+# SSL contexts holding PIA's CA certificate, keyed by the path it was read from
+ssl_contexts = {}
+
+def get_ssl_context():
+    """
+    Get an SSL context that trusts only PIA's CA. The certificate is read
+    once per process, rather than for every new connection, as happens when
+    `requests` is given the path of a CA bundle.
+    """
+    try:
+        return ssl_contexts[ca_path]
+    except KeyError:
+        pass
+    context = create_urllib3_context()
+    context.load_verify_locations(cafile=ca_path)
+    ssl_contexts[ca_path] = context
+    return context
 
 class DNSBypassAdapter(HTTPAdapter):
     """
@@ -19,7 +42,8 @@ class DNSBypassAdapter(HTTPAdapter):
     The code for this class is based mainly on a StackOverflow answer by user
     Sarah Messer (https://stackoverflow.com/a/26473516).
     """
-    def __init__(self, common_name, host, *args, **kwargs):
+    def __init__(self, common_name, host, *args, socket_options=(), source_ip=None,
+                 **kwargs):
         """
         Create a DNSBypassAdapter for a specific server.
 
@@ -27,9 +51,15 @@ class DNSBypassAdapter(HTTPAdapter):
         ----------
         common_name: The server's hostname, as specified in its TLS certificate.
         host: The server's IP address (or publicly-resolvable hostname).
+        socket_options: Extra options to set on each connection's socket
+                        (see `probe.bypass_socket_options()`)
+        source_ip: Local address to connect from (e.g. a tunnel's own
+                   address, so that the connection is routed through it)
         """
         self.common_name = common_name
         self.host = host
+        self.socket_options = list(socket_options)
+        self.source_ip = source_ip
         super().__init__(*args, **kwargs)
 
     def get_connection(self, url, proxies=None):
@@ -46,12 +76,87 @@ class DNSBypassAdapter(HTTPAdapter):
         For now I'm leaving both in place.
         """
         request.url = request.url.replace(self.common_name, self.host)
-        return super().get_connection_with_tls_context(request, verify, proxies=proxies, cert=cert)
+        # certificates are verified against the pool manager's SSL context,
+        # so don't have requests pass on a CA bundle path to be loaded again
+        return super().get_connection_with_tls_context(request, True, proxies=proxies, cert=cert)
+
+    def cert_verify(self, conn, url, verify, cert):
+        """
+        Require a valid certificate, checked against the pool manager's SSL
+        context (see `get_ssl_context()`), instead of setting a CA bundle
+        on each connection as the base class does.
+        """
+        conn.cert_reqs = 'CERT_REQUIRED'
+        conn.ca_certs = None
+        conn.ca_cert_dir = None
 
     def init_poolmanager(self, connections, maxsize, **kwargs):
         """
         Override the init_poolmanager() method of the base HTTPSAdapter,
-        setting `assert_hostname` to `common_name`.
+        setting `assert_hostname` to `common_name`, verifying certificates
+        with the shared context trusting PIA's CA, and adding any extra
+        socket options and source address.
         """
         kwargs['assert_hostname'] = self.common_name
+        kwargs['ssl_context'] = get_ssl_context()
+        if self.socket_options:
+            kwargs['socket_options'] = (
+                HTTPConnection.default_socket_options + self.socket_options
+            )
+        if self.source_ip is not None:
+            kwargs['source_address'] = (self.source_ip, 0)
         super().init_poolmanager(connections, maxsize, **kwargs)
+
+# Sessions for talking to individual PIA servers, keyed by (common name, IP,
+# network namespace, socket options, source address)
+sessions = {}
+
+def current_netns():
+    """
+    Identify the network namespace of the calling thread (by the inode
+    number of its namespace file), or `None` if this can't be determined.
+    """
+    try:
+        return os.stat('/proc/thread-self/ns/net').st_ino
+    except OSError:
+        return None
+
+def get_session(cn, ip, socket_options=(), source_ip=None):
+    """
+    Get a `requests.Session` for communicating with a PIA server over HTTPS,
+    verified against PIA's CA certificate.
+
+    Sessions are kept for the life of the process, so that repeated requests
+    to the same server (e.g. addKey, then getSignature and bindPort, or
+    periodic port renewals) reuse kept-alive connections instead of doing
+    a new TCP and TLS handshake each time.
+
+    Parameters
+    ----------
+    cn: The server's hostname, as specified in its TLS certificate.
+    ip: The server's IP address.
+    socket_options: Extra options to set on the sockets (see
+                    `probe.bypass_socket_options()`)
+    source_ip: Local address to connect from
+    """
+    # connections opened from inside a network namespace (see `netns`)
+    # can't be used from outside it, or from another one
+    key = (cn, ip, current_netns(), tuple(socket_options), source_ip)
+    try:
+        return sessions[key]
+    except KeyError:
+        pass
+    session = Session()
+    session.mount(f'https://{cn}', DNSBypassAdapter(
+        cn, ip, socket_options=socket_options, source_ip=source_ip,
+    ))
+    sessions[key] = session
+    return session
+
+def close_sessions():
+    """
+    Close all sessions opened by `get_session()`.
+    """
+    for session in sessions.values():
+        session.close()
+    sessions.clear()
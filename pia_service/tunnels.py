@@ -0,0 +1,186 @@
+import contextlib
+import fcntl
+import os
+import re
+import toml
+package_dir = os.path.dirname(__file__)
+registry_path = os.path.join(package_dir, 'tunnels.toml')
+# held while allocating a routing table, since the registry itself is
+# replaced rather than rewritten in place
+registry_lock_path = os.path.join(package_dir, 'tunnels.lock')
+
+# The default tunnel keeps the names used before multiple tunnels were
+# supported: interface "pia", status.toml, pia-vpn.service, and so on.
+default_name = 'pia'
+default_table = 16673
+
+class InvalidTunnelName(Exception):
+    def __init__(self, name):
+        super().__init__(f"Invalid tunnel name {name!r}")
+        self.name = name
+
+def check_name(name):
+    """
+    Check that `name` can be used as a network interface name (and hence
+    in file and systemd unit names).
+    """
+    if not re.fullmatch(r'[A-Za-z0-9_.-]{1,15}', name) or name in ('.', '..'):
+        raise InvalidTunnelName(name)
+    return name
+
+def status_path(name=default_name):
+    """
+    Path of the status file for a tunnel.
+    """
+    if name == default_name:
+        return os.path.join(package_dir, 'status.toml')
+    return os.path.join(package_dir, f'status-{name}.toml')
+
+def saved_status_path(name=default_name):
+    """
+    Path of the file the status of a tunnel is kept in after disconnecting,
+    so the connection can be restored with `reconnect`.
+    """
+    if name == default_name:
+        return os.path.join(package_dir, 'saved-status.toml')
+    return os.path.join(package_dir, f'saved-status-{name}.toml')
+
+def reconnect_marker_path(name=default_name):
+    """
+    Path of the file that exists while `reconnect` starts a tunnel's
+    pia-vpn.service, telling the unit's `refresh` to leave the saved
+    configuration as it is.
+    """
+    if name == default_name:
+        return os.path.join(package_dir, 'reconnecting')
+    return os.path.join(package_dir, f'reconnecting-{name}')
+
+def load_status(name=default_name):
+    """
+    Load the status of a tunnel, or `None` if it isn't connected.
+    """
+    try:
+        with open(status_path(name), 'r') as f:
+            return toml.load(f)
+    except FileNotFoundError:
+        return None
+
+def load_saved_status(name=default_name):
+    """
+    Load the status a tunnel had when it was last disconnected, or `None`.
+    """
+    try:
+        with open(saved_status_path(name), 'r') as f:
+            return toml.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_status(status, name=default_name, path=None):
+    """
+    Write the status of a tunnel, readable only by the owner (to its status
+    file, unless another `path` is given).
+    """
+    if path is None:
+        path = status_path(name)
+    old_umask = os.umask(0o177)
+    try:
+        with open(path, 'w') as f:
+            toml.dump(status, f)
+    finally:
+        os.umask(old_umask)
+
+def restore_ownership():
+    """
+    Hand state files created while running as root (e.g. by the refresh
+    run by pia-vpn.service at boot) back to the owner of the package
+    directory, so that later commands run by that user can update them.
+    """
+    if os.geteuid() != 0:
+        return
+    owner = os.stat(package_dir)
+    if owner.st_uid == 0:
+        return
+    for entry in os.scandir(package_dir):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        if not entry.name.endswith(('.toml', '.json', '.jsonl', '.lock')):
+            continue
+        if entry.stat(follow_symlinks=False).st_uid == 0:
+            os.chown(entry.path, owner.st_uid, owner.st_gid, follow_symlinks=False)
+
+def connected_tunnels():
+    """
+    Names of all tunnels that have a status file, default tunnel first.
+    """
+    names = []
+    if os.path.exists(status_path(default_name)):
+        names.append(default_name)
+    for filename in sorted(os.listdir(package_dir)):
+        match = re.fullmatch(r'status-(.+)\.toml', filename)
+        if match:
+            names.append(match.group(1))
+    return names
+
+def unit_name(unit, name=default_name):
+    """
+    Name of one of the systemd units for a tunnel, e.g. `pia-vpn.service`
+    for the default tunnel and `pia-vpn-us1.service` for a tunnel `us1`.
+    """
+    if name == default_name:
+        return unit
+    base, suffix = unit.rsplit('.', 1)
+    return f'{base}-{name}.{suffix}'
+
+@contextlib.contextmanager
+def locked_registry():
+    """
+    Context manager holding the lock on the tunnel registry, yielding the
+    mapping of tunnel names to routing tables. Changes made to the mapping
+    are written back (to a temporary file that replaces the registry, only
+    readable by the owner) when the context exits.
+    """
+    old_umask = os.umask(0o177)
+    try:
+        with open(registry_lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                tables = toml.load(registry_path)
+            except FileNotFoundError:
+                tables = {}
+            original = dict(tables)
+            yield tables
+            if tables != original:
+                tmp_path = f"{registry_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    toml.dump(tables, f)
+                os.replace(tmp_path, registry_path)
+    finally:
+        os.umask(old_umask)
+
+def routing_table(name=default_name):
+    """
+    Get the routing table number (also used as the fwmark) for a tunnel,
+    allocating and recording a new one if the tunnel hasn't been seen before.
+    The registry is locked while doing so, so that tunnels connected at the
+    same time never get the same table.
+    """
+    if name == default_name:
+        return default_table
+    with locked_registry() as tables:
+        if name not in tables:
+            used = set(tables.values()) | {default_table}
+            table = default_table + 1
+            while table in used:
+                table += 1
+            tables[name] = table
+        return tables[name]
+
+def release_routing_table(name=default_name):
+    """
+    Forget the routing table of a tunnel that has been removed for good, so
+    that its number can be given to another tunnel.
+    """
+    if name == default_name:
+        return
+    with locked_registry() as tables:
+        tables.pop(name, None)